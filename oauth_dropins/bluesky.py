@@ -28,7 +28,7 @@ from requests_oauth2client import (
 )
 from webutil import flask_util, util
 from webutil.models import JsonProperty
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import views, models
 
@@ -86,7 +86,7 @@ def error(msg):
   raise ValueError(msg)
 
 
-class BlueskyLogin(ndb.Model):
+class BlueskyLogin(models.EphemeralModel):
   """An in-progress Bluesky OAuth login. Ephemeral.
 
   Stores a serialized :class:`requests_oauth2client.AuthorizationRequest` across
@@ -106,7 +106,7 @@ class BlueskyLogin(ndb.Model):
     if not util.is_int(id):
       error(f'State {id} not found')
 
-    login = cls.get_by_id(int(id))
+    login = models.state_store.get(ndb.Key(cls, int(id)))
     if not login:
       error(f'State {id} not found')
 
@@ -120,7 +120,7 @@ class BlueskyAuth(models.BaseAuth):
   """
   password = ndb.StringProperty()
   pds_url = ndb.StringProperty()
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
   """app.bsky.actor.defs#profileViewDetailed"""
   session = JsonProperty()
   dpop_token = ndb.TextProperty()
@@ -141,14 +141,14 @@ class BlueskyAuth(models.BaseAuth):
     Returns:
       str:
     """
-    return json_loads(self.user_json).get('handle')
+    return self.parsed_json().get('handle')
 
   def image_url(self):
     """
     Returns:
       str:
     """
-    return json_loads(self.user_json).get('avatar')
+    return self.parsed_json().get('avatar')
 
   def oauth_api(self, client_metadata):
     """Returns an OAuth-based :class:`lexrpc.Client` for this user.
@@ -172,6 +172,9 @@ class BlueskyAuth(models.BaseAuth):
     return Client(pds_url, auth=auth, requests_session=util.session,
                   headers=headers())
 
+  def _api_credentials(self):
+    return [self.pds_url, self.password, self.session]
+
   def _api(self, **kwargs):
     """
     Args:
@@ -275,7 +278,7 @@ class PasswordCallback(views.Callback):
       user_json=util.json_dumps(profile),
       session=client.session,
     )
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=state)
 
 Callback = PasswordCallback
@@ -402,7 +405,7 @@ class OAuthStart(StartBase):
 
     client = oauth_client_for_pds(self.CLIENT_METADATA, pds_for_did(did),
                                   redirect_uri=redirect_uri)
-    login_key = BlueskyLogin.allocate_ids(1)[0]
+    login_key = models.state_store.allocate_key(BlueskyLogin)
 
     try:
       authz_request = client.authorization_request(
@@ -412,7 +415,8 @@ class OAuthStart(StartBase):
       error(e)
 
     serialized = AuthorizationRequestSerializer().dumps(authz_request)
-    BlueskyLogin(key=login_key, state=state, did=did, authz_request=serialized).put()
+    models.state_store.put(BlueskyLogin(key=login_key, state=state, did=did,
+                                        authz_request=serialized))
 
     return par_request.uri
 
@@ -478,7 +482,7 @@ class OAuthCallback(views.Callback):
                        pds_url=pds_url,
                        dpop_token=TokenSerializer().dumps(token),
                        user_json=util.json_dumps(profile))
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=login.state)
 
 
@@ -14,6 +14,7 @@ Facebook. Differences:
 
 TODO: unify Disqus, Facebook, and Instagram
 """
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import urllib.parse
 
@@ -38,6 +39,10 @@ GET_AUTH_CODE_URL = (
     )))
 GET_ACCESS_TOKEN_URL = 'https://disqus.com/api/oauth/2.0/access_token/'
 USER_DETAILS_URL = 'https://disqus.com/api/3.0/users/details.json?user=%d'
+API_BASE_URL = 'https://disqus.com/api/3.0'
+# max allowed by list endpoints
+# https://disqus.com/api/docs/cursors/
+LIST_PAGE_SIZE = 100
 
 
 class DisqusAuth(models.BaseAuth):
@@ -47,23 +52,24 @@ class DisqusAuth(models.BaseAuth):
   OAuth-signed requests to Instagram's HTTP-based APIs. Stores OAuth credentials
   in the datastore. See :class:`models.BaseAuth` for usage details.
 
-  Disqus-specific details: implements :meth:`urlopen` but not :meth:`api`.
+  Disqus-specific details: implements :meth:`urlopen` and :meth:`iter_list`
+  but not :meth:`api`.
   The key name is the Disqus user id.
   """
   auth_code = ndb.StringProperty(required=True)
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Disqus'
 
   def user_display_name(self):
     """Returns the user's name."""
-    return json_loads(self.user_json)['name']
+    return self.parsed_json()['name']
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatar', {}).get('permalink', {})
+    return self.parsed_json().get('avatar', {}).get('permalink', {})
 
   def access_token(self):
     """Returns the OAuth access token string."""
@@ -76,6 +82,70 @@ class DisqusAuth(models.BaseAuth):
     return models.BaseAuth.urlopen_access_token(url, self.access_token_str,
                                                 DISQUS_CLIENT_ID, **kwargs)
 
+  def iter_list(self, endpoint, params=None, limit=None, prefetch=False):
+    """Generator that yields the items from a paginated list endpoint.
+
+    Follows ``cursor.next`` lazily, fetching :data:`LIST_PAGE_SIZE` items per
+    page, so only one or two pages are in memory at once.
+
+    https://disqus.com/api/docs/cursors/
+
+    Args:
+      endpoint (str): eg ``forums/listPosts``, or a full URL
+      params (dict or sequence of (str, str) tuples): query params, eg
+        ``{'forum': 'my-forum'}``
+      limit (int): max number of items to yield. Defaults to all of them.
+      prefetch (bool): whether to fetch the next page in the background while
+        the caller processes the current page
+
+    Yields:
+      dict: items from the ``response`` list
+    """
+    url = (endpoint if endpoint.startswith('http')
+           else f"{API_BASE_URL}/{endpoint.strip('/').removesuffix('.json')}.json")
+    if isinstance(params, dict):
+      params = list(params.items())
+    params = [(k, v) for k, v in params or () if k not in ('cursor', 'limit')]
+
+    def page_size(remaining):
+      return (LIST_PAGE_SIZE if remaining is None
+              else min(LIST_PAGE_SIZE, remaining))
+
+    def fetch(cursor, size):
+      page_params = params + [('limit', size)]
+      if cursor:
+        page_params.append(('cursor', cursor))
+      resp = json_loads(self.urlopen(util.add_query_params(url, page_params)).read())
+      cursor = resp.get('cursor') or {}
+      return (resp.get('response') or [],
+              cursor.get('next') if cursor.get('hasNext') else None)
+
+    if limit is not None and limit <= 0:
+      return
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    remaining = limit
+    try:
+      items, next_cursor = fetch(None, page_size(remaining))
+      while True:
+        if remaining is not None:
+          items = items[:remaining]
+          remaining -= len(items)
+
+        future = None
+        if next_cursor and executor and remaining != 0:
+          future = executor.submit(fetch, next_cursor, page_size(remaining))
+
+        yield from items
+
+        if not next_cursor or remaining == 0:
+          return
+        items, next_cursor = future.result() if future else fetch(next_cursor, page_size(remaining))
+
+    finally:
+      if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 class Start(views.Start):
   """Starts Disqus auth. Requests an auth code and expects a redirect back.
@@ -140,7 +210,7 @@ class Callback(views.Callback):
 
     auth.user_json = json_dumps(user_data)
     logger.info(f'created disqus auth {auth}')
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=request.values.get('state'))
 
   def handle_error(handler):
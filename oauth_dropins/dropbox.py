@@ -5,15 +5,20 @@ Standard OAuth 2.0 flow. Docs:
 * https://www.dropbox.com/developers/documentation/http/overview
 * https://www.dropbox.com/developers/documentation/http/documentation#authorization
 """
+import io
 import logging
+import mmap
+import os
 import urllib.parse, urllib.request
 
 from flask import request
 from google.cloud import ndb
+import requests
 from webutil import flask_util, util
 from webutil.util import json_dumps, json_loads
 
 from . import views, models
+from .urlopen import pooled_urlopen
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +33,13 @@ GET_AUTH_CODE_URL = '&'.join((
 ))
 GET_ACCESS_TOKEN_URL = 'https://api.dropbox.com/oauth2/token'
 
+# https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-start
+CONTENT_API_URL = 'https://content.dropboxapi.com/2'
+# Dropbox allows up to 150MB per request. Multiples of 4MB are most efficient.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# keep this below webutil.util.MAX_HTTP_RESPONSE_SIZE
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class DropboxAuth(models.BaseAuth):
   """An authenticated Dropbox user or page.
@@ -36,7 +48,8 @@ class DropboxAuth(models.BaseAuth):
   OAuth-signed requests to Dropbox's HTTP-based APIs. Stores OAuth credentials
   in the datastore. See :class:`models.BaseAuth` for usage details.
 
-  Implements :meth:`urlopen` but not :meth:`api`.
+  Implements :meth:`urlopen` but not :meth:`api`. :meth:`upload` and
+  :meth:`download` stream large files in chunks.
   """
   access_token_str = ndb.StringProperty(required=True)
 
@@ -59,13 +72,173 @@ class DropboxAuth(models.BaseAuth):
     """Wraps urlopen() and adds OAuth credentials to the request."""
     headers = {'Authorization': f'Bearer {self.access_token_str}'}
     try:
-      return util.urlopen(urllib.request.Request(url, headers=headers), **kwargs)
+      return pooled_urlopen(urllib.request.Request(url, headers=headers), **kwargs)
+    except BaseException as e:
+      util.interpret_http_exception(e)
+      raise
+
+  def _content_request(self, endpoint, arg, headers=None, **kwargs):
+    """Makes a request to Dropbox's content API and returns the response.
+
+    Args:
+      endpoint (str): eg ``files/upload_session/start``
+      arg: JSON-serializable ``Dropbox-API-Arg`` value
+      headers (dict): additional HTTP headers
+      kwargs: passed through to :func:`webutil.util.requests_post`
+
+    Returns:
+      requests.Response:
+
+    Raises:
+      requests.HTTPError: on HTTP error
+    """
+    resp = util.requests_post(f'{CONTENT_API_URL}/{endpoint}', headers={
+      'Authorization': f'Bearer {self.access_token_str}',
+      # must be ASCII, so escape non-ASCII characters
+      'Dropbox-API-Arg': json_dumps(arg, ensure_ascii=True),
+      **(headers or {}),
+    }, log_data=False, **kwargs)
+    try:
+      resp.raise_for_status()
     except BaseException as e:
       util.interpret_http_exception(e)
       raise
+    return resp
+
+  def upload(self, file, path, mode='add', autorename=False,
+             chunk_size=UPLOAD_CHUNK_SIZE, session_id=None, offset=0,
+             progress=None):
+    """Uploads a file with Dropbox's upload session API.
+
+    Runs ``upload_session/start``, ``append_v2``, and ``finish``, one chunk at a
+    time, so at most one chunk is in memory at once. Files that fit in a single
+    chunk are uploaded with one ``files/upload`` request instead.
+
+    To resume an interrupted upload, pass the ``session_id`` and ``offset``
+    from the last ``progress`` call.
+
+    https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-start
+
+    Args:
+      file: file-like object opened in binary mode, or str path to a file, which
+        will be memory-mapped
+      path (str): destination path in Dropbox, eg ``/photos/cat.jpg``
+      mode (str): write mode, ``add`` or ``overwrite``
+      autorename (bool): whether to rename the file if there's a conflict
+      chunk_size (int): bytes per request
+      session_id (str): existing upload session to resume
+      offset (int): number of bytes already uploaded to ``session_id``. If
+        ``session_id`` is provided, ``file`` is read starting at this position.
+      progress (callable): called with ``(session_id, offset)`` after each
+        chunk is uploaded
+
+    Returns:
+      dict: the uploaded file's metadata
+
+    Raises:
+      requests.HTTPError: on HTTP error
+    """
+    if isinstance(file, (str, os.PathLike)):
+      with open(file, 'rb') as f:
+        kwargs = {'mode': mode, 'autorename': autorename,
+                  'chunk_size': chunk_size, 'session_id': session_id,
+                  'offset': offset, 'progress': progress}
+        if not os.fstat(f.fileno()).st_size:
+          # mmap can't map empty files
+          return self.upload(io.BytesIO(b''), path, **kwargs)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          return self.upload(mm, path, **kwargs)
+
+    commit = {
+      'path': path,
+      'mode': mode,
+      'autorename': autorename,
+    }
+    headers = {'Content-Type': 'application/octet-stream'}
+
+    if session_id:
+      file.seek(offset)
+    chunk = file.read(chunk_size)
+
+    if not session_id:
+      if len(chunk) < chunk_size:
+        return self._content_request('files/upload', commit, headers=headers,
+                                     data=chunk).json()
+      session_id = self._content_request(
+        'files/upload_session/start', {'close': False}, headers=headers,
+        data=chunk).json()['session_id']
+      offset = len(chunk)
+      logger.info(f'Started Dropbox upload session {session_id} for {path}')
+      if progress:
+        progress(session_id, offset)
+      chunk = file.read(chunk_size)
+
+    while len(chunk) == chunk_size:
+      self._content_request('files/upload_session/append_v2', {
+        'cursor': {'session_id': session_id, 'offset': offset},
+        'close': False,
+      }, headers=headers, data=chunk)
+      offset += len(chunk)
+      if progress:
+        progress(session_id, offset)
+      chunk = file.read(chunk_size)
+
+    # the last chunk, which may be empty
+    return self._content_request('files/upload_session/finish', {
+      'cursor': {'session_id': session_id, 'offset': offset},
+      'commit': commit,
+    }, headers=headers, data=chunk).json()
+
+  def download(self, path, sink, offset=0, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Downloads a file with ranged requests and writes it to a sink.
+
+    Fetches and writes one chunk at a time, so at most one chunk is in memory
+    at once. To resume an interrupted download, pass the number of bytes
+    already written as ``offset``.
+
+    https://www.dropbox.com/developers/documentation/http/documentation#files-download
+
+    Args:
+      path (str): Dropbox path, id, or revision, eg ``/photos/cat.jpg``
+      sink: file-like object opened in binary mode to write to
+      offset (int): byte offset to start downloading from
+      chunk_size (int): bytes per request
+
+    Returns:
+      dict: the file's metadata, or None if there was nothing left to download
+
+    Raises:
+      requests.HTTPError: on HTTP error
+    """
+    metadata = None
+
+    while True:
+      try:
+        resp = self._content_request('files/download', {'path': path}, headers={
+          'Range': f'bytes={offset}-{offset + chunk_size - 1}',
+        })
+      except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 416:
+          # offset is at or past the end of the file
+          return metadata
+        raise
+
+      metadata = json_loads(resp.headers.get('Dropbox-API-Result') or '{}')
+      for data in resp.iter_content(chunk_size=io.DEFAULT_BUFFER_SIZE):
+        sink.write(data)
+        offset += len(data)
+
+      # 200 means Dropbox ignored the Range header and returned the whole file
+      if resp.status_code != 206:
+        return metadata
+
+      # Content-Range is bytes START-END/TOTAL
+      total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+      if not total.isdigit() or offset >= int(total):
+        return metadata
 
 
-class DropboxCsrf(ndb.Model):
+class DropboxCsrf(models.EphemeralModel):
   """Stores a CSRF token for the Dropbox OAuth2 flow."""
   token = ndb.StringProperty(required=False)
   state = ndb.TextProperty(required=False)
@@ -82,7 +255,7 @@ class Start(views.Start):
       "Please fill in the dropbox_app_key and dropbox_app_secret files in "
       "your app's root directory.")
 
-    csrf_key = DropboxCsrf(state=state).put()
+    csrf_key = models.state_store.put(DropboxCsrf(state=state))
     return GET_AUTH_CODE_URL % {
       'client_id': DROPBOX_APP_KEY,
       'redirect_uri': urllib.parse.quote_plus(self.to_url(state=state)),
@@ -118,13 +291,13 @@ class Callback(views.Callback):
     except (ValueError, TypeError):
       flask_util.error(f'Invalid state value {state!r}')
 
-    csrf = DropboxCsrf.get_by_id(csrf_id)
+    csrf = models.state_store.get(ndb.Key(DropboxCsrf, csrf_id))
     if not csrf:
       flask_util.error(f'No CSRF token for id {csrf_id}')
 
     # request an access token
     try:
-      resp = util.urlopen(GET_ACCESS_TOKEN_URL, data=urllib.parse.urlencode({
+      resp = pooled_urlopen(GET_ACCESS_TOKEN_URL, data=urllib.parse.urlencode({
         'grant_type': 'authorization_code',
         'client_id': DROPBOX_APP_KEY,
         'client_secret': DROPBOX_APP_SECRET,
@@ -143,5 +316,5 @@ class Callback(views.Callback):
 
     logger.info(f"Storing new Dropbox account: {data['uid']}")
     auth = DropboxAuth(id=data['uid'], access_token_str=data['access_token'])
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=csrf.state)
@@ -11,6 +11,7 @@ from webutil import appengine_info, flask_util, util
 from webutil.util import json_dumps, json_loads
 
 from . import views, models
+from .urlopen import pooled_urlopen
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +50,12 @@ GET_ACCESS_TOKEN_URL = '&'.join((
 API_USER_URL = API_BASE + 'me?fields=id,email,name,picture'
 API_PAGE_URL = API_BASE + 'me?fields=id,about,cover,description,emails,general_info,is_published,link,location,name,personal_info,phone,username,website'
 API_PAGES_URL = API_BASE + 'me/accounts'
+# fetches the user and their pages in one request with field expansion. more
+# pages are fetched from the accounts paging.next URL.
+# https://developers.facebook.com/docs/graph-api/field-expansion
+# https://developers.facebook.com/docs/graph-api/results
+PAGES_LIMIT = 100
+API_USER_AND_PAGES_URL = API_BASE + f'me?fields=id,email,name,picture,accounts.limit({PAGES_LIMIT}){{id,name,access_token,category,category_list,tasks}}'
 
 
 class FacebookAuth(models.BaseAuth):
@@ -65,16 +72,19 @@ class FacebookAuth(models.BaseAuth):
   auth_code = ndb.StringProperty()
   access_token_str = ndb.StringProperty(required=True)
   # https://developers.facebook.com/docs/graph-api/reference/user#fields
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
   # https://developers.facebook.com/docs/graph-api/reference/user/accounts#fields
-  pages_json = ndb.TextProperty()
+  pages_json = models.CompressedJsonProperty()
+
+  # (pages_json, frozenset of page ids). Initialized on demand.
+  _page_ids = None
 
   def site_name(self):
     return 'Facebook'
 
   def user_display_name(self):
     """Returns the user's or page's name."""
-    return json_loads(self.user_json)['name']
+    return self.parsed_json()['name']
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
@@ -90,7 +100,20 @@ class FacebookAuth(models.BaseAuth):
     return models.BaseAuth.urlopen_access_token(url, self.access_token_str,
                                                 **kwargs)
 
-  def for_page(self, page_id):
+  def page_ids(self):
+    """Returns the ids of the pages in :attr:`pages_json`.
+
+    Cached until :attr:`pages_json` changes.
+
+    Returns:
+      frozenset of str:
+    """
+    if self._page_ids is None or self._page_ids[0] is not self.pages_json:
+      ids = frozenset(page.get('id') for page in self.parsed_json('pages_json') or [])
+      self._page_ids = (self.pages_json, ids)
+    return self._page_ids[1]
+
+  def for_page(self, page_id, fetch=True):
     """Returns a new, unsaved :class:`FacebookAuth` entity for a page in :attr:`pages_json`.
 
     The returned entity's properties will be populated with the page's data.
@@ -102,31 +125,40 @@ class FacebookAuth(models.BaseAuth):
 
     Args:
       page_id (str): Facebook page id
+      fetch (bool): whether to fetch the full page object from the Graph API
+        for :attr:`user_json`. If False, :attr:`user_json` is the page's entry
+        in :attr:`pages_json`.
     """
-    for page in json_loads(self.pages_json):
+    if page_id not in self.page_ids():
+      return None
+
+    for page in self.parsed_json('pages_json'):
       id = page.get('id')
       if id == page_id:
         entity = FacebookAuth(id=id, type='page', pages_json=json_dumps([page]),
                               access_token_str=page.get('access_token'))
-        entity.user_json = entity.urlopen(API_PAGE_URL).read()
-        logger.debug(f'Page object: {entity.user_json}')
+        if fetch:
+          entity.user_json = entity.urlopen(API_PAGE_URL).read()
+          logger.debug(f'Page object: {entity.user_json}')
+        else:
+          entity.user_json = json_dumps(page)
         return entity
 
-    return None
-
   def is_authority_for(self, key):
     """Additionally check if the key represents a Page that this user has
     authority over.
 
+    Only checks :attr:`pages_json`, doesn't make any HTTP requests.
+
     Args:
       auth_entity_key (google.cloud.ndb.key.Key)
 
     Returns:
       bool: True if key represents this user or one of the user's pages.
     """
-    return super().is_authority_for(key) or any(
-      key == self.for_page(page.get('id')).key
-      for page in json_loads(self.pages_json))
+    return super().is_authority_for(key) or (
+      key.kind() == FacebookAuth._get_kind() and key.parent() is None
+      and key.id() in self.page_ids())
 
 
 class Start(views.Start):
@@ -165,7 +197,7 @@ class Callback(views.Callback):
       'redirect_uri': urllib.parse.quote_plus(request.base_url),
     }
     try:
-      resp = json_loads(util.urlopen(url).read())
+      resp = json_loads(pooled_urlopen(url).read())
     except urllib.error.HTTPError as e:
       logger.error(e.read())
       raise
@@ -173,21 +205,29 @@ class Callback(views.Callback):
     logger.debug(f'Access token response: {resp}')
     access_token = resp['access_token']
 
-    user = models.BaseAuth.urlopen_access_token(API_USER_URL, access_token).read()
+    user = json_loads(models.BaseAuth.urlopen_access_token(
+      API_USER_AND_PAGES_URL, access_token).read())
+    accounts = user.pop('accounts', {})
     logger.debug(f'User info response: {user}')
-    user_id = json_loads(user)['id']
-
-    pages = json_dumps(json_loads(models.BaseAuth.urlopen_access_token(
-      API_PAGES_URL, access_token).read()).get('data'))
-    logger.debug(f'Pages response: {pages}')
 
-    auth = FacebookAuth(id=user_id,
+    # follow pagination cursors
+    pages = accounts.get('data', [])
+    while next := accounts.get('paging', {}).get('next'):
+      try:
+        accounts = json_loads(pooled_urlopen(next).read())
+      except BaseException as e:
+        util.interpret_http_exception(e)
+        raise
+      pages.extend(accounts.get('data', []))
+    logger.debug(f'Pages: {pages}')
+
+    auth = FacebookAuth(id=user['id'],
                         type='user',
-                        user_json=user,
-                        pages_json=pages,
+                        user_json=json_dumps(user),
+                        pages_json=json_dumps(pages),
                         auth_code=auth_code,
                         access_token_str=access_token)
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=request.values.get('state'))
 
   @staticmethod
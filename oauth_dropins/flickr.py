@@ -16,6 +16,7 @@ from webutil import flask_util, util
 from webutil.util import json_dumps, json_loads
 
 from . import flickr_auth, views, models
+from .urlopen import pooled_urlopen
 
 logger = logging.getLogger(__name__)
 
@@ -35,11 +36,14 @@ class FlickrAuth(models.BaseAuth):
   usage details.
   """
   SCOPES_RESET = True
+  USER_JSON_FIELDS = ('person.id', 'person.nsid', 'person.username',
+                      'person.realname', 'person.iconserver', 'person.iconfarm',
+                      'person.profileurl')
 
   # access token
   token_key = ndb.StringProperty(required=True)
   token_secret = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Flickr'
@@ -73,6 +77,29 @@ class FlickrAuth(models.BaseAuth):
     return flickr_auth.call_api_method(
       method, params, self.token_key, self.token_secret)
 
+  def call_api_methods(self, calls, **kwargs):
+    """Calls API methods in parallel. See :func:`flickr_auth.call_api_methods`."""
+    return flickr_auth.call_api_methods(calls, self.token_key, self.token_secret,
+                                        **kwargs)
+
+  def upload(self, params, file):
+    """Uploads a photo or video. See :func:`flickr_auth.upload`."""
+    return flickr_auth.upload(params, file, self.token_key, self.token_secret)
+
+  def upload_async(self, params, file):
+    """Starts an asynchronous upload. See :func:`flickr_auth.upload_async`."""
+    return flickr_auth.upload_async(params, file, self.token_key,
+                                    self.token_secret)
+
+  def ticket_poller(self, **kwargs):
+    """Returns a :class:`flickr_auth.TicketPoller` for this user's uploads."""
+    return flickr_auth.TicketPoller(self.token_key, self.token_secret, **kwargs)
+
+  def upload_many(self, uploads, **kwargs):
+    """Uploads photos and/or videos in parallel. See :func:`flickr_auth.upload_many`."""
+    return flickr_auth.upload_many(uploads, self.token_key, self.token_secret,
+                                   **kwargs)
+
 
 class Start(views.Start):
   """Starts three-legged OAuth with Flickr.
@@ -114,10 +141,10 @@ class Start(views.Start):
     if not resource_owner_key or not resource_owner_secret:
       flask_util.error(f'Unexpected Flickr error: {resp.text}')
 
-    models.OAuthRequestToken(
+    models.state_store.put(models.OAuthRequestToken(
       id=resource_owner_key[0],
       token_secret=resource_owner_secret[0],
-      state=state).put()
+      state=state))
 
     if self.scope:
       auth_url = AUTHORIZE_URL + '?' + urllib.parse.urlencode({
@@ -147,7 +174,8 @@ class Callback(views.Callback):
   def dispatch_request(self):
     oauth_token = request.values.get('oauth_token')
     oauth_verifier = request.values.get('oauth_verifier')
-    request_token = models.OAuthRequestToken.get_by_id(oauth_token)
+    request_token = models.state_store.get(
+      ndb.Key(models.OAuthRequestToken, oauth_token))
 
     client = oauthlib.oauth1.Client(
       flickr_auth.FLICKR_APP_KEY,
@@ -158,7 +186,7 @@ class Callback(views.Callback):
 
     uri, headers, body = client.sign(ACCESS_TOKEN_URL)
     try:
-      resp = util.urlopen(urllib.request.Request(uri, body, headers))
+      resp = pooled_urlopen(urllib.request.Request(uri, body, headers))
     except BaseException as e:
       util.interpret_http_exception(e)
       raise
@@ -175,6 +203,6 @@ class Callback(views.Callback):
     user_json = auth.call_api_method('flickr.people.getInfo', {'user_id': user_nsid})
 
     auth.user_json = json_dumps(user_json)
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))
@@ -2,8 +2,15 @@
 
 Supports Python 3. Should not depend on App Engine API or SDK packages.
 """
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
 import logging
+import mmap
+import os
 import re
+import secrets
+import threading
+import time
 import urllib.error, urllib.parse, urllib.request
 
 import oauthlib.oauth1
@@ -12,11 +19,45 @@ import requests
 from webutil import util
 from webutil.util import json_dumps, json_loads
 
+from .urlopen import pooled_urlopen
+
 logger = logging.getLogger(__name__)
 
 FLICKR_APP_KEY = util.read('flickr_app_key')
 FLICKR_APP_SECRET = util.read('flickr_app_secret')
 
+API_URL = 'https://api.flickr.com/services/rest'
+UPLOAD_URL = 'https://up.flickr.com/services/upload'
+
+# max number of concurrent calls in call_api_methods. keep this at or below
+# webutil.util.session's per-host connection pool size.
+API_MAX_WORKERS = 8
+
+# max number of concurrent uploads in upload_many
+UPLOAD_MAX_WORKERS = 4
+
+# bytes per chunk when streaming an upload of unknown size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# TicketPoller defaults
+TICKETS_BATCH_SIZE = 50
+TICKETS_POLL_INTERVAL = 5  # seconds
+TICKETS_TIMEOUT = 60 * 60  # seconds
+
+
+def signer(token_key, token_secret):
+  """Returns an :class:`oauthlib.oauth1.Client` that signs requests for a user.
+
+  Args:
+    token_key (str): user's access token
+    token_secret (str): the user's access token secret
+  """
+  return oauthlib.oauth1.Client(
+    FLICKR_APP_KEY,
+    client_secret=FLICKR_APP_SECRET,
+    resource_owner_key=token_key,
+    resource_owner_secret=token_secret)
+
 
 def signed_urlopen(url, token_key, token_secret, **kwargs):
   """Call :func:`urllib.request.urlopen`, signing the request with Flickr credentials.
@@ -31,14 +72,9 @@ def signed_urlopen(url, token_key, token_secret, **kwargs):
   Returns:
     the file-like object that is the result of :func:`urllib.request.urlopen`
   """
-  auth = oauthlib.oauth1.Client(
-    FLICKR_APP_KEY,
-    client_secret=FLICKR_APP_SECRET,
-    resource_owner_key=token_key,
-    resource_owner_secret=token_secret)
-  uri, headers, body = auth.sign(url, **kwargs)
+  uri, headers, body = signer(token_key, token_secret).sign(url, **kwargs)
   try:
-    return util.urlopen(urllib.request.Request(uri, body, headers))
+    return pooled_urlopen(urllib.request.Request(uri, body, headers))
   except BaseException as e:
     util.interpret_http_exception(e)
     raise
@@ -52,6 +88,32 @@ def raise_for_failure(url, code, msg):
     url, http_code, f'message={msg}, flickr code={int(code)}', {}, None)
 
 
+def _api_method_url(method, params):
+  """Returns the API endpoint URL for calling a method."""
+  full_params = {
+    'nojsoncallback': 1,
+    'format': 'json',
+    'method': method,
+  }
+  full_params.update(params)
+  return API_URL + '?' + urllib.parse.urlencode(full_params)
+
+
+def _parse_api_response(url, text):
+  """Parses an API method's JSON response and checks its ``stat``."""
+  try:
+    body = json_loads(text)
+  except BaseException:
+    logger.warning(f'Ignoring malformed flickr response: {text[:1000]}')
+    body = {}
+
+  # Flickr returns HTTP success even for errors, so we have to fake it
+  if body.get('stat') == 'fail':
+    raise_for_failure(url, body.get('code'), body.get('message'))
+
+  return body
+
+
 def call_api_method(method, params, token_key, token_secret):
   """Call a Flickr API method.
 
@@ -69,30 +131,170 @@ def call_api_method(method, params, token_key, token_secret):
   Return:
     dict: json object response from the API
   """
-  full_params = {
-    'nojsoncallback': 1,
-    'format': 'json',
-    'method': method,
-  }
-  full_params.update(params)
-  url = 'https://api.flickr.com/services/rest?' + urllib.parse.urlencode(full_params)
+  url = _api_method_url(method, params)
   resp = signed_urlopen(url, token_key, token_secret)
+  return _parse_api_response(url, resp.read())
+
+
+def call_api_methods(calls, token_key, token_secret,
+                     max_workers=API_MAX_WORKERS):
+  """Calls multiple Flickr API methods in parallel.
+
+  Flickr doesn't have a batch endpoint, so this runs the calls concurrently in
+  a bounded thread pool over :data:`webutil.util.session`'s keep-alive
+  connections, with a single shared signer.
+
+  Failures are handled like :func:`call_api_method`, per call: HTTP errors and
+  ``stat=fail`` responses become :class:`urllib.error.HTTPError`\s. They're
+  returned instead of raised.
+
+  Args:
+    calls (sequence of (str method, dict params) tuples)
+    token_key (str): the user's API access token
+    token_secret (str): the user's API access token secret
+    max_workers (int): max number of calls to run at once
+
+  Return:
+    list: one result per call, in the same order, either the JSON dict response
+    or the exception
+  """
+  auth = signer(token_key, token_secret)
+
+  def call(method_params):
+    url = _api_method_url(*method_params)
+    uri, headers, _ = auth.sign(url)
+    try:
+      resp = util.requests_get(uri, headers=headers)
+      if not resp.ok:
+        raise urllib.error.HTTPError(url, resp.status_code, resp.text,
+                                     resp.headers, None)
+      return _parse_api_response(url, resp.text)
+    except BaseException as e:
+      logger.info(f'{method_params[0]} failed: {e}')
+      return e
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(call, calls))
+
+
+def _quote_param(value):
+  """Escapes a ``Content-Disposition`` parameter value, like HTML5 forms do.
+
+  https://html.spec.whatwg.org/multipage/form-control-infrastructure.html#multipart-form-data
+  """
+  return (str(value).replace('"', '%22').replace('\r', '%0D')
+          .replace('\n', '%0A'))
+
+
+def _remaining_size(file):
+  """Returns the number of bytes left in a file, or None if it's not seekable.
+
+  Args:
+    file: file-like object or :class:`mmap.mmap`
+
+  Returns:
+    int or None:
+  """
+  seekable = getattr(file, 'seekable', None)
+  if seekable and not seekable():
+    return None
 
-  text = resp.read()
   try:
-    body = json_loads(text)
-  except BaseException:
-    logger.warning(f'Ignoring malformed flickr response: {text[:1000]}')
-    body = {}
+    start = file.tell()
+    file.seek(0, io.SEEK_END)
+    size = file.tell() - start
+    file.seek(start)
+  except (AttributeError, OSError):
+    return None
 
-  # Flickr returns HTTP success even for errors, so we have to fake it
-  if body.get('stat') == 'fail':
-    raise_for_failure(url, body.get('code'), body.get('message'))
+  return size
 
-  return body
 
+class MultipartStream:
+  """A file-like ``multipart/form-data`` request body that streams a file.
+
+  Reads form fields and the file's contents on demand, so the body is never
+  fully in memory. If the file's size is known, it has a length, so
+  :mod:`requests` sends ``Content-Length``. Otherwise, send its iterator to
+  use chunked transfer encoding instead.
 
-def upload(params, file, token_key, token_secret):
+  Attributes:
+    content_type (str): ``Content-Type`` header value, including the boundary
+    length (int): total body size in bytes, or None if the file's size is
+      unknown
+  """
+  def __init__(self, fields, name, file, filename=None, size=None):
+    """Constructor.
+
+    Args:
+      fields (sequence of (str, str) tuples): form fields
+      name (str): form field name for the file
+      file: file-like object or :class:`mmap.mmap`, opened in binary mode
+      filename (str): defaults to ``file.name``'s basename or ``name``
+      size (int): bytes remaining in ``file``. Defaults to its size from its
+        current position if it's seekable. Otherwise, it's read until EOF.
+    """
+    boundary = secrets.token_hex(16)
+    self.content_type = f'multipart/form-data; boundary={boundary}'
+
+    if size is None:
+      size = _remaining_size(file)
+
+    if filename is None:
+      filename = os.path.basename(str(getattr(file, 'name', ''))) or name
+
+    head = b''.join(
+      f'--{boundary}\r\nContent-Disposition: form-data; name="{_quote_param(key)}"\r\n\r\n{val}\r\n'.encode()
+      for key, val in fields)
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; '
+             f'name="{_quote_param(name)}"; filename="{_quote_param(filename)}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    self._parts = [io.BytesIO(head), (file, size), io.BytesIO(tail)]
+    self.length = None if size is None else len(head) + size + len(tail)
+    self._file_remaining = size
+
+  def __len__(self):
+    if self.length is None:
+      raise TypeError('length is unknown')
+    return self.length
+
+  def __iter__(self):
+    """Yields the body in chunks of up to :const:`UPLOAD_CHUNK_SIZE` bytes."""
+    while chunk := self.read(UPLOAD_CHUNK_SIZE):
+      yield chunk
+
+  def read(self, size=-1):
+    """Reads and returns up to ``size`` bytes of the body."""
+    if size is None or size < 0:
+      return b''.join(iter(self))
+
+    chunks = []
+    while size > 0 and self._parts:
+      part = self._parts[0]
+      if isinstance(part, tuple):
+        file, _ = part
+        if self._file_remaining is None:
+          chunk = file.read(size)
+          if not chunk:
+            self._parts.pop(0)
+        else:
+          chunk = file.read(min(size, self._file_remaining))
+          self._file_remaining -= len(chunk)
+          if not chunk or not self._file_remaining:
+            self._parts.pop(0)
+      else:
+        chunk = part.read(size)
+        if not chunk:
+          self._parts.pop(0)
+      chunks.append(chunk)
+      size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def upload(params, file, token_key, token_secret, size=None):
   """Upload a photo or video to this user's Flickr account.
 
   Flickr uploads use their own API endpoint, that returns only XML.
@@ -101,11 +303,18 @@ def upload(params, file, token_key, token_secret):
   Unlike :func:`call_api_method`, this uses the requests library because
   :mod:`urllib` doesn't support multi-part POSTs on its own.
 
+  Streams the request body from ``file``, so it's never fully in memory. If
+  ``file`` isn't seekable, eg an HTTP response or a pipe, and ``size`` isn't
+  provided, the body is sent with chunked transfer encoding.
+
   Args:
     params (dict): the parameters to send to the API method
-    file (file-like object): the image or video to upload
+    file (file-like object): the image or video to upload, opened in binary
+      mode, or a str path to a file, which will be memory-mapped
     token_key (str): the user's API access token
     token_secret (str): the user's API access token secret
+    size (int): bytes to upload from ``file``. Defaults to its size, if it's
+      seekable.
 
   Return:
     dict: contains the photo id as ``id``
@@ -114,7 +323,63 @@ def upload(params, file, token_key, token_secret):
     requests.HTTPError: on HTTP error
     urllib.error.HTTPError: if we get a ``stat=fail`` response from Flickr
   """
-  upload_url = 'https://up.flickr.com/services/upload'
+  text = _upload(params, file, token_key, token_secret, size=size)
+  m = re.search(r'<photoid>(\d+)</photoid>', text, re.DOTALL)
+  if not m:
+    raise BaseException(
+      f'Expected response with <photoid>...</photoid>. Got: {text}')
+
+  return {'id': m.group(1)}
+
+
+def upload_async(params, file, token_key, token_secret, size=None):
+  """Starts an asynchronous upload of a photo or video.
+
+  Returns as soon as Flickr has received the file, before it finishes
+  processing it. Use a :class:`TicketPoller` to get the resulting photo id.
+  https://www.flickr.com/services/api/upload.async.html
+
+  Args:
+    params (dict): the parameters to send to the API method
+    file (file-like object): the image or video to upload, opened in binary
+      mode, or a str path to a file, which will be memory-mapped
+    token_key (str): the user's API access token
+    token_secret (str): the user's API access token secret
+    size (int): see :func:`upload`
+
+  Return:
+    str: upload ticket id
+
+  Raises:
+    requests.HTTPError: on HTTP error
+    urllib.error.HTTPError: if we get a ``stat=fail`` response from Flickr
+  """
+  text = _upload({**params, 'async': 1}, file, token_key, token_secret,
+                 size=size)
+  m = re.search(r'<ticketid>([^<]+)</ticketid>', text, re.DOTALL)
+  if not m:
+    raise BaseException(
+      f'Expected response with <ticketid>...</ticketid>. Got: {text}')
+
+  return m.group(1)
+
+
+def _upload(params, file, token_key, token_secret, filename=None, size=None):
+  """Uploads a file and checks the response's ``stat``.
+
+  Returns:
+    str: response body
+  """
+  if isinstance(file, (str, os.PathLike)):
+    filename = os.path.basename(file)
+    with open(file, 'rb') as f:
+      if not os.fstat(f.fileno()).st_size:
+        # mmap can't map empty files
+        return _upload(params, io.BytesIO(b''), token_key, token_secret,
+                       filename=filename, size=0)
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _upload(params, mm, token_key, token_secret, filename=filename)
+
   auth = requests_oauthlib.OAuth1(
       client_key=FLICKR_APP_KEY,
       client_secret=FLICKR_APP_SECRET,
@@ -124,12 +389,15 @@ def upload(params, file, token_key, token_secret):
 
   # create a request with files for signing
   faux_req = requests.Request(
-    'POST', upload_url, data=params, auth=auth).prepare()
+    'POST', UPLOAD_URL, data=params, auth=auth).prepare()
   # parse the signed parameters back out of the body
   data = urllib.parse.parse_qsl(faux_req.body.decode('utf-8'))
 
   # and use them in the real request
-  resp = util.requests_post(upload_url, data=data, files={'photo': file})
+  body = MultipartStream(data, 'photo', file, filename=filename, size=size)
+  resp = util.requests_post(UPLOAD_URL, log_data=False,
+                            data=body if body.length is not None else iter(body),
+                            headers={'Content-Type': body.content_type})
   logger.debug(f'upload response: {resp}, {resp.text}')
   resp.raise_for_status()
 
@@ -144,11 +412,153 @@ def upload(params, file, token_key, token_secret):
     if not m:
       raise BaseException(
         f'Expected response with <err code="..." msg=".." />. Got: {resp.text}')
-    raise_for_failure(upload_url, int(m.group(1)), m.group(2))
+    raise_for_failure(UPLOAD_URL, int(m.group(1)), m.group(2))
 
-  m = re.search(r'<photoid>(\d+)</photoid>', resp.text, re.DOTALL)
-  if not m:
-    raise BaseException(
-      f'Expected response with <photoid>...</photoid>. Got: {resp.text}')
+  return resp.text
 
-  return {'id': m.group(1)}
+
+def upload_many(uploads, token_key, token_secret, max_workers=UPLOAD_MAX_WORKERS):
+  """Uploads multiple photos and/or videos in parallel.
+
+  Runs :func:`upload` for each item in a bounded thread pool.
+
+  Args:
+    uploads (sequence of (dict params, file) tuples): see :func:`upload`
+    token_key (str): the user's API access token
+    token_secret (str): the user's API access token secret
+    max_workers (int): max number of uploads to run at once
+
+  Return:
+    list: one result per upload, in the same order, either the dict
+    :func:`upload` returned or the exception it raised
+  """
+  def upload_one(params_file):
+    params, file = params_file
+    try:
+      return upload(params, file, token_key, token_secret)
+    except BaseException as e:
+      logger.info(f'Upload failed: {e}')
+      return e
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(upload_one, uploads))
+
+
+class TicketPoller:
+  """Resolves asynchronous upload tickets into photo ids.
+
+  Polls ``flickr.photos.upload.checkTickets`` for many tickets at once, in
+  batches, on a background thread that runs while any tickets are pending.
+  https://www.flickr.com/services/api/flickr.photos.upload.checkTickets.html
+
+  Each ticket gets a :class:`concurrent.futures.Future` that resolves to a dict
+  with the photo id as ``id``, like :func:`upload`, or fails with
+  :class:`urllib.error.HTTPError` if Flickr couldn't process the upload or
+  :class:`TimeoutError` if it didn't finish within :attr:`timeout`.
+
+  Example::
+
+    poller = TicketPoller(token_key, token_secret)
+    ticket = upload_async(params, file, token_key, token_secret)
+    future = poller.add(ticket, callback=lambda f: print(f.result()['id']))
+
+  Attributes:
+    interval (float): seconds between polls
+    batch_size (int): max tickets per ``checkTickets`` call
+    timeout (float): seconds after which pending tickets fail
+  """
+  def __init__(self, token_key, token_secret, interval=TICKETS_POLL_INTERVAL,
+               batch_size=TICKETS_BATCH_SIZE, timeout=TICKETS_TIMEOUT):
+    self.token_key = token_key
+    self.token_secret = token_secret
+    self.interval = interval
+    self.batch_size = batch_size
+    self.timeout = timeout
+    self._pending = {}  # maps ticket id to (Future, deadline)
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def add(self, ticket_id, callback=None):
+    """Starts tracking an upload ticket.
+
+    Args:
+      ticket_id (str): from :func:`upload_async`
+      callback (callable): optional, called with the ticket's
+        :class:`concurrent.futures.Future` when it resolves
+
+    Returns:
+      concurrent.futures.Future:
+    """
+    future = Future()
+    if callback:
+      future.add_done_callback(callback)
+
+    with self._lock:
+      self._pending[ticket_id] = (future, time.monotonic() + self.timeout)
+      if not self._thread:
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='flickr-ticket-poller')
+        self._thread.start()
+
+    return future
+
+  def pending(self):
+    """Returns the number of unresolved tickets."""
+    with self._lock:
+      return len(self._pending)
+
+  def _run(self):
+    while True:
+      time.sleep(self.interval)
+      self.poll()
+      with self._lock:
+        if not self._pending:
+          self._thread = None
+          return
+
+  def poll(self):
+    """Checks all pending tickets once and resolves the finished ones.
+
+    Called automatically by the background thread, but may also be called
+    directly.
+    """
+    with self._lock:
+      ticket_ids = list(self._pending.keys())
+
+    for i in range(0, len(ticket_ids), self.batch_size):
+      batch = ticket_ids[i:i + self.batch_size]
+      try:
+        resp = call_api_method('flickr.photos.upload.checkTickets',
+                               {'tickets': ','.join(batch)},
+                               self.token_key, self.token_secret)
+      except BaseException as e:
+        logger.info(f'checkTickets failed, will retry: {e}')
+        continue
+
+      for ticket in resp.get('uploader', {}).get('ticket', []):
+        id = ticket.get('id')
+        complete = int(ticket.get('complete') or 0)
+        if ticket.get('invalid') or complete == 2:
+          self._resolve(id, exception=urllib.error.HTTPError(
+            API_URL, 400, f'Flickr failed to process upload ticket {id}', {}, None))
+        elif complete == 1:
+          self._resolve(id, result={'id': ticket.get('photoid')})
+
+    now = time.monotonic()
+    with self._lock:
+      expired = [id for id, (_, deadline) in self._pending.items()
+                 if deadline < now]
+    for id in expired:
+      self._resolve(id, exception=TimeoutError(
+        f'Flickr upload ticket {id} not complete after {self.timeout}s'))
+
+  def _resolve(self, ticket_id, result=None, exception=None):
+    with self._lock:
+      future, _ = self._pending.pop(ticket_id, (None, None))
+
+    if not future:
+      return
+    elif exception:
+      future.set_exception(exception)
+    else:
+      future.set_result(result)
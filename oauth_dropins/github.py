@@ -5,16 +5,19 @@ API docs:
 * https://developer.github.com/v4/
 * https://developer.github.com/apps/building-oauth-apps/authorization-options-for-oauth-apps/#web-application-flow
 """
+import copy
+import hashlib
 import logging
 import urllib.parse
 
 from flask import request
 from google.cloud import ndb
+from requests.structures import CaseInsensitiveDict
 from webutil import appengine_info, flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import views
-from .models import BaseAuth
+from .models import BaseAuth, CompressedJsonProperty, LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -40,22 +43,95 @@ GET_ACCESS_TOKEN_URL = 'https://github.com/login/oauth/access_token'
 
 API_GRAPHQL = 'https://api.github.com/graphql'
 # https://developer.github.com/v4/object/user/
-GRAPHQL_USER = {
-  'query': """
-query {
-  viewer {
+GRAPHQL_USER_FIELDS = """
     id
     login
     name
     url
     avatarUrl
-    id
     location
     websiteUrl
     bio
-  }
-}""",
+"""
+GRAPHQL_USER = {
+  'query': f"""
+query {{
+  viewer {{{GRAPHQL_USER_FIELDS}  }}
+}}""",
 }
+# max number of users to fetch in a single GraphQL query in refresh_users
+# https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
+GRAPHQL_USERS_BATCH_SIZE = 100
+
+# headers in 304 responses that describe the (empty) 304 body, not the cached
+# response, so they're not copied onto it
+NOT_MODIFIED_SKIP_HEADERS = frozenset((
+  'content-encoding',
+  'content-length',
+  'transfer-encoding',
+))
+
+# request headers that aren't part of ETagCache keys. Authorization is included
+# as a hash, and If-None-Match is added from the cache. All other request
+# headers are, since GitHub's responses vary on some of them, eg Accept.
+ETAG_KEY_SKIP_HEADERS = frozenset((
+  'authorization',
+  'if-none-match',
+))
+
+
+class ETagCache(LRUCache):
+  """Caches GitHub REST API GET responses and their ETags.
+
+  Used to send conditional requests with ``If-None-Match``. GitHub doesn't count
+  ``304 Not Modified`` responses against the rate limit.
+  https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+
+  Keys are (access token hash, URL, request headers) tuples, where request
+  headers is a sorted tuple of (lower case name, value) tuples. Values are
+  (ETag, response) tuples.
+  Responses with bodies larger than :attr:`max_body_size` aren't cached.
+
+  Attributes:
+    max_body_size (int): bytes
+    not_modified (int): number of 304 responses served from the cache
+    modified (int): number of conditional requests that got a new response
+  """
+  def __init__(self, max_size, max_body_size=1024 * 1024, **kwargs):
+    super().__init__(max_size, **kwargs)
+    self.max_body_size = max_body_size
+    self.not_modified = self.modified = 0
+
+  def clear(self):
+    super().clear()
+    with self._lock:
+      self.not_modified = self.modified = 0
+
+  def count(self, not_modified):
+    """Records the result of a conditional request.
+
+    Args:
+      not_modified (bool): whether the response was ``304 Not Modified``
+    """
+    with self._lock:
+      if not_modified:
+        self.not_modified += 1
+      else:
+        self.modified += 1
+
+  def stats(self):
+    """Adds ``not_modified``, ``modified``, and ``not_modified_ratio`` to
+    :meth:`LRUCache.stats`."""
+    stats = super().stats()
+    with self._lock:
+      not_modified, modified = self.not_modified, self.modified
+    conditional = not_modified + modified
+    return {
+      **stats,
+      'not_modified': not_modified,
+      'modified': modified,
+      'not_modified_ratio': not_modified / conditional if conditional else 0,
+    }
 
 
 class GitHubAuth(BaseAuth):
@@ -67,9 +143,17 @@ class GitHubAuth(BaseAuth):
 
   GitHub-specific details: implements :meth:`get` but not :meth:`urlopen`, or
   :meth:`api`. The key name is the username.
+
+  Attributes:
+    etag_cache (ETagCache): optional. If set, :meth:`get` sends conditional
+      requests with cached ETags and returns the cached response when GitHub
+      responds ``304 Not Modified``. Shared by all instances. Set on the class
+      to enable, eg ``GitHubAuth.etag_cache = ETagCache(1000)``.
   """
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty()
+  user_json = CompressedJsonProperty()
+
+  etag_cache = None
 
   def site_name(self):
     return 'GitHub'
@@ -80,7 +164,7 @@ class GitHubAuth(BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatarUrl')
+    return self.parsed_json().get('avatarUrl')
 
   def access_token(self):
     """Returns the OAuth access token string."""
@@ -94,11 +178,87 @@ class GitHubAuth(BaseAuth):
     """Wraps :func:`requests.post` and adds the ``Bearer`` token header. """
     return self._requests_call(util.requests_post, *args, **kwargs)
 
+  @classmethod
+  def refresh_users(cls, auths, access_token=None):
+    """Refetches many users' profiles and stores the ones that changed.
+
+    Fetches users in batches of up to :const:`GRAPHQL_USERS_BATCH_SIZE` with a
+    single GraphQL query per batch, one aliased ``user(login:)`` field per user,
+    then stores the entities whose :attr:`user_json` changed with a single
+    :func:`ndb.put_multi`. Users that GitHub doesn't return, eg because
+    they've been renamed or deleted, are left unchanged.
+
+    Args:
+      auths (sequence of GitHubAuth)
+      access_token (str): token to use. Defaults to the first entity's.
+
+    Returns:
+      list of GitHubAuth: the entities that changed and were stored
+    """
+    auths = list(auths)
+    if not auths:
+      return []
+
+    client = cls(access_token_str=access_token or auths[0].access_token_str)
+
+    changed = []
+    for i in range(0, len(auths), GRAPHQL_USERS_BATCH_SIZE):
+      batch = auths[i:i + GRAPHQL_USERS_BATCH_SIZE]
+      fields = ''.join(
+        f'  u{j}: user(login: {json_dumps(auth.key_id())}) {{{GRAPHQL_USER_FIELDS}  }}\n'
+        for j, auth in enumerate(batch))
+      resp = client.post(API_GRAPHQL, json={'query': f'query {{\n{fields}}}'}).json()
+      for error in resp.get('errors') or []:
+        logger.info(f"Couldn't fetch user: {error}")
+
+      data = resp.get('data') or {}
+      for j, auth in enumerate(batch):
+        if user := data.get(f'u{j}'):
+          if user != auth.parsed_json():
+            auth.user_json = json_dumps(user)
+            changed.append(auth)
+
+    if changed:
+      logger.info(f'Storing {len(changed)} changed users')
+      ndb.put_multi(changed)
+
+    return changed
+
   def _requests_call(self, fn, *args, **kwargs):
     headers = kwargs.setdefault('headers', {})
     headers['Authorization'] = 'Bearer ' + self.access_token_str
 
+    cache = self.etag_cache if fn is util.requests_get else None
+    cached = None
+    if cache is not None:
+      token_hash = hashlib.sha256(self.access_token_str.encode()).hexdigest()
+      url = util.add_query_params(args[0], kwargs.get('params') or {})
+      key_headers = tuple(sorted(
+        (name.lower(), val) for name, val in headers.items()
+        if name.lower() not in ETAG_KEY_SKIP_HEADERS))
+      cache_key = (token_hash, url, key_headers)
+      if cached := cache.get(cache_key):
+        headers['If-None-Match'] = cached[0]
+
     resp = fn(*args, **kwargs)
+
+    if cached and resp.status_code == 304:
+      cache.count(not_modified=True)
+      # cached responses are shared, so return a copy, with the 304's headers,
+      # eg current rate limits
+      # https://www.rfc-editor.org/rfc/rfc9111#section-4.3.4
+      not_modified = resp
+      resp = copy.copy(cached[1])
+      resp.headers = CaseInsensitiveDict(resp.headers)
+      resp.headers.update({name: val for name, val in not_modified.headers.items()
+                           if name.lower() not in NOT_MODIFIED_SKIP_HEADERS})
+      return resp
+    elif cache is not None and resp.ok and (etag := resp.headers.get('ETag')):
+      if cached:
+        cache.count(not_modified=False)
+      if len(resp.content) <= cache.max_body_size:
+        cache.set(cache_key, (etag, resp))
+
     assert 'errors' not in resp, resp
 
     try:
@@ -175,6 +335,6 @@ class Callback(views.Callback):
     user_json = resp['data']['viewer']
     auth = GitHubAuth(id=user_json['login'], access_token_str=access_token,
                       user_json=json_dumps(user_json))
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))
@@ -10,9 +10,10 @@ requests-oauthlib docs:
 * https://requests-oauthlib.readthedocs.io/en/latest/examples/google.html
 """
 import logging
+import re
 
 from flask import request
-from google.cloud import ndb
+from requests_oauth2client import IdToken
 from requests_oauthlib import OAuth2Session
 from webutil import flask_util, util
 from webutil.util import json_dumps, json_loads
@@ -29,6 +30,81 @@ ACCESS_TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
 #   https://accounts.google.com/.well-known/openid-configuration
 # Background: https://developers.google.com/identity/protocols/OpenIDConnect#discovery
 OPENID_CONNECT_USERINFO = 'https://openidconnect.googleapis.com/v1/userinfo'
+OPENID_CONFIGURATION_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+# https://developers.google.com/identity/openid-connect/openid-connect#validatinganidtoken
+ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+
+# id_token claims to store in user_json. if any of the required ones are
+# missing, we fetch OPENID_CONNECT_USERINFO instead.
+USER_CLAIMS = ('sub', 'name', 'given_name', 'family_name', 'picture', 'email',
+               'email_verified', 'locale')
+REQUIRED_USER_CLAIMS = ('sub', 'name', 'picture')
+
+# caches the discovery document and JWKS. maps URL to parsed JSON.
+_json_cache = models.LRUCache(10)
+
+
+def get_json_cached(url, refresh=False):
+  """Fetches and returns a JSON document, cached according to its Cache-Control.
+
+  Args:
+    url (str)
+    refresh (bool): whether to ignore the cache and refetch
+
+  Returns:
+    dict:
+  """
+  if not refresh and (cached := _json_cache.get(url)) is not None:
+    return cached
+
+  resp = util.requests_get(url)
+  resp.raise_for_status()
+  doc = resp.json()
+
+  cache_control = resp.headers.get('Cache-Control', '')
+  if 'no-store' not in cache_control and 'no-cache' not in cache_control:
+    if max_age := re.search(r'max-age=(\d+)', cache_control):
+      _json_cache.set(url, doc, ttl=int(max_age.group(1)))
+
+  return doc
+
+
+def verify_id_token(id_token):
+  """Verifies a Google OpenID Connect ID token locally and returns its claims.
+
+  Checks the signature against Google's JWKS, the issuer, the audience, and
+  expiration. The discovery document and JWKS are cached.
+  https://developers.google.com/identity/openid-connect/openid-connect#validatinganidtoken
+
+  Args:
+    id_token (str): JWT
+
+  Returns:
+    dict: claims
+
+  Raises:
+    ValueError: if the token is invalid
+  """
+  token = IdToken(id_token)
+  jwks_uri = get_json_cached(OPENID_CONFIGURATION_URL)['jwks_uri']
+
+  def find_key(jwks):
+    for key in jwks.get('keys', []):
+      if key.get('kid') == token.kid:
+        return key
+
+  key = find_key(get_json_cached(jwks_uri))
+  if not key:
+    # Google may have rotated its keys
+    key = find_key(get_json_cached(jwks_uri, refresh=True))
+  if not key:
+    raise ValueError(f'No key in JWKS with kid {token.kid}')
+
+  token.validate(key, audience=GOOGLE_CLIENT_ID)
+  if token.issuer not in ISSUERS:
+    raise ValueError(f'Unexpected id_token issuer {token.issuer}')
+
+  return token.claims
 
 
 class GoogleUser(models.BaseAuth):
@@ -40,23 +116,23 @@ class GoogleUser(models.BaseAuth):
 
   To make Google API calls: https://google-auth.readthedocs.io/
   """
-  user_json = ndb.TextProperty()
-  token_json = ndb.TextProperty()
+  user_json = models.CompressedJsonProperty()
+  token_json = models.CompressedJsonProperty()
 
   def site_name(self):
     return 'Google'
 
   def user_display_name(self):
     """Returns the user's name."""
-    return json_loads(self.user_json).get('name') or 'unknown'
+    return self.parsed_json().get('name') or 'unknown'
 
   def image_url(self):
     """Returns the user's name."""
-    return json_loads(self.user_json)['picture']
+    return self.parsed_json()['picture']
 
   def access_token(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.token_json)['access_token']
+    return self.parsed_json('token_json')['access_token']
 
 
 class Scopes(object):
@@ -113,19 +189,31 @@ class Callback(Scopes, views.Callback):
                         client_secret=GOOGLE_CLIENT_SECRET,
                         authorization_response=request.url)
 
-    # get OpenID Connect user info
+    # get user info from the OpenID Connect id_token if possible, otherwise
+    # fetch it from the userinfo endpoint
     # https://openid.net/specs/openid-connect-core-1_0.html#StandardClaims
-    resp = session.get(OPENID_CONNECT_USERINFO)
-    try:
-      resp.raise_for_status()
-    except BaseException as e:
-      util.interpret_http_exception(e)
-      raise
-
-    user_json = json_loads(resp.text)
-    logger.info('Got one person', user_json)
+    user_json = None
+    if id_token := session.token.get('id_token'):
+      try:
+        claims = verify_id_token(id_token)
+        if all(claims.get(claim) for claim in REQUIRED_USER_CLAIMS):
+          user_json = {claim: claims[claim] for claim in USER_CLAIMS
+                       if claim in claims}
+      except BaseException as e:
+        logger.warning(f"Couldn't verify id_token: {e}")
+
+    if not user_json:
+      resp = session.get(OPENID_CONNECT_USERINFO)
+      try:
+        resp.raise_for_status()
+      except BaseException as e:
+        util.interpret_http_exception(e)
+        raise
+      user_json = json_loads(resp.text)
+
+    logger.info(f'Got one person: {user_json}')
 
     user = GoogleUser(id=user_json['sub'], user_json=json_dumps(user_json),
                       token_json=json_dumps(session.token))
-    user.put()
+    user.put_if_changed()
     return self.finish(user, state=state)
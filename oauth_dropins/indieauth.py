@@ -11,7 +11,7 @@ import mf2util
 import pkce
 import requests
 from webutil import appengine_info, flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import models, views
 
@@ -80,7 +80,7 @@ class IndieAuth(models.BaseAuth):
   in the datastore. Key is the authed ``me`` URL value. See
   :class:`models.BaseAuth` for usage details.
   """
-  user_json = ndb.TextProperty(required=True)  # generally this has only 'me'
+  user_json = models.CompressedJsonProperty(required=True)  # generally this has only 'me'
   access_token_str = ndb.StringProperty()
   refresh_token_str = ndb.StringProperty()
 
@@ -93,7 +93,7 @@ class IndieAuth(models.BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    hcard = json_loads(self.user_json).get('h-card', {})
+    hcard = self.parsed_json().get('h-card', {})
     if photos := hcard.get('properties', {}).get('photo', []):
       return photos[0] if isinstance(photos[0], str) else photos[0].get('value')
 
@@ -222,7 +222,7 @@ class Callback(views.Callback):
                                access_token_str=data.get('access_token'),
                                refresh_token_str=data.get('refresh_token'),
                                )
-        indie_auth.put()
+        indie_auth.put_if_changed()
         return self.finish(indie_auth, state=state)
       else:
         flask_util.error('Verification response missing required "me" field')
@@ -50,7 +50,7 @@ class InstagramAuth(models.BaseAuth):
   """
   auth_code = ndb.StringProperty(required=True)
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Instagram'
@@ -144,5 +144,5 @@ class Callback(views.Callback):
                          auth_code=auth_code,
                          access_token_str=access_token,
                          user_json=json_dumps(data['user']))
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=request.values.get('state'))
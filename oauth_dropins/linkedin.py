@@ -13,7 +13,7 @@ from webutil import flask_util, util
 from webutil.util import json_dumps, json_loads
 
 from . import views
-from .models import BaseAuth
+from .models import BaseAuth, CompressedJsonProperty
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +49,7 @@ class LinkedInAuth(BaseAuth):
   https://docs.microsoft.com/en-us/linkedin/shared/authentication/authorization-code-flow?context=linkedin/consumer/context#access-token-response
   """
   access_token_str = ndb.TextProperty(required=True)
-  user_json = ndb.TextProperty()
+  user_json = CompressedJsonProperty()
 
   def site_name(self):
     return 'LinkedIn'
@@ -57,7 +57,7 @@ class LinkedInAuth(BaseAuth):
   def user_display_name(self):
     """Returns the user's first and last name."""
     def name(field):
-      user = json_loads(self.user_json)
+      user = self.parsed_json()
       loc = user.get(field, {}).get('localized', {})
       if loc:
           return loc.get('en_US') or loc.values()[0]
@@ -168,6 +168,6 @@ class Callback(views.Callback):
     logger.debug(f'Profile response: {resp}')
     auth = LinkedInAuth(id=resp['id'], access_token_str=access_token,
                         user_json=json_dumps(resp))
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))
@@ -25,8 +25,8 @@ from webutil.util import (
   json_loads,
 )
 
-from . import views
-from .models import BaseAuth
+from . import models, views
+from .models import BaseAuth, CompressedJsonProperty, EntityCacheMixin
 
 logger = logging.getLogger(__name__)
 
@@ -86,17 +86,17 @@ AUTH_CODE_API = '&'.join((
 ACCESS_TOKEN_API = '/oauth/token'
 
 
-class MastodonApp(ndb.Model):
+class MastodonApp(EntityCacheMixin, ndb.Model):
   """A Mastodon API OAuth2 app registered with a specific instance."""
   instance = ndb.StringProperty(required=True)  # URL, eg https://mastodon.social/
   data = ndb.TextProperty(required=True)  # JSON; includes client id/secret
-  instance_info = ndb.TextProperty()  # JSON; from /api/v1/instance
+  instance_info = CompressedJsonProperty()  # JSON; from /api/v1/instance
   app_url = ndb.StringProperty()
   app_name = ndb.StringProperty()
   created_at = ndb.DateTimeProperty(auto_now_add=True, required=True)
 
 
-class MastodonLogin(ndb.Model):
+class MastodonLogin(models.EphemeralModel):
   """An in-progress Mastodon OAuth login. Ephemeral.
 
   Stores the state query parameter across the three-way OAuth user login
@@ -113,7 +113,7 @@ class MastodonLogin(ndb.Model):
     if not util.is_int(id):
       flask_util.error(f'State {id} not found')
 
-    login = cls.get_by_id(int(id))
+    login = models.state_store.get(ndb.Key(cls, int(id)))
     if not login:
       flask_util.error(f'State {id} not found')
 
@@ -137,10 +137,12 @@ class MastodonAuth(BaseAuth):
   Implements get() and post() but not urlopen() or api().
   """
   SCOPES_RESET = True
+  USER_JSON_FIELDS = ('id', 'username', 'acct', 'uri', 'url', 'display_name',
+                      'avatar_static')
 
   app = ndb.KeyProperty()
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty()
+  user_json = CompressedJsonProperty()
 
   def site_name(self):
     return 'Mastodon'
@@ -155,7 +157,7 @@ class MastodonAuth(BaseAuth):
     Raises:
       RuntimeError: when the :class:`MastodonApp` can't be loaded
     """
-    if not (app := self.app.get()):
+    if not (app := models.load_many([self.app])[0]):
       views.logout(self)
       msg = f'{self.key} app {self.app} is missing! logging it out'
       logger.error(msg)
@@ -165,22 +167,22 @@ class MastodonAuth(BaseAuth):
 
   def username(self):
     """Returns the user's username, eg ryan."""
-    return json_loads(self.user_json).get('username')
+    return self.parsed_json().get('username')
 
   def user_id(self):
     """Returns the user's id, eg 123."""
-    return json_loads(self.user_json).get('id')
+    return self.parsed_json().get('id')
 
   def actor_id(self):
     """Returns the user's ActivityPub actor id URL.
 
     Example: ``https://mastodon.social/users/ryan``
     """
-    return json_loads(self.user_json).get('uri')
+    return self.parsed_json().get('uri')
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatar_static')
+    return self.parsed_json().get('avatar_static')
 
   def access_token(self):
     """Returns the OAuth access token string."""
@@ -333,7 +335,8 @@ class Start(views.Start):
 
     logger.info(f'Starting OAuth for {self.LABEL} instance {instance}')
     app_data = json_loads(app.data)
-    login_id = MastodonLogin(app=app.key, state=state or '').put().id()
+    login_id = models.state_store.put(
+      MastodonLogin(app=app.key, state=state or '')).id()
     return urljoin(instance, AUTH_CODE_API % {
       'client_id': app_data['client_id'],
       'redirect_uri': quote_plus(self.to_url()),
@@ -459,6 +462,6 @@ class Callback(views.Callback):
     address = f"@{user['username']}@{urlparse(app.instance).netloc}"
     auth = self.AUTH_CLASS(id=address, app=app.key, access_token_str=access_token,
                            user_json=json_dumps(user))
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=login.state)
@@ -11,8 +11,9 @@ from google.cloud import ndb
 from webutil import appengine_info, flask_util, util
 from webutil.util import json_loads
 
-from . import views
-from .models import BaseAuth
+from . import models, views
+from .models import BaseAuth, CompressedJsonProperty
+from .urlopen import pooled_urlopen
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +41,7 @@ def urlopen_bearer_token(url, access_token, data=None, **kwargs):
   """
   headers = {'Authorization': f'Bearer {access_token}'}
   try:
-    return util.urlopen(urllib.request.Request(url, headers=headers, data=data), **kwargs)
+    return pooled_urlopen(urllib.request.Request(url, headers=headers, data=data), **kwargs)
   except BaseException as e:
     util.interpret_http_exception(e)
     raise
@@ -56,28 +57,28 @@ class MeetupAuth(BaseAuth):
   Implements urlopen() but not api().
   """
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Meetup.com'
 
   def user_display_name(self):
     """Returns the Meetup.com user id."""
-    return json_loads(self.user_json)['name']
+    return self.parsed_json()['name']
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatar')
+    return self.parsed_json().get('avatar')
 
   def access_token(self):
     """Returns the OAuth access token string."""
     return self.access_token_str
 
   def urlopen(self, url, **kwargs):
-    return urlopen_bearer_token(url, self.access_token_str, kwargs)
+    return urlopen_bearer_token(url, self.access_token_str, **kwargs)
 
 
-class MeetupCsrf(ndb.Model):
+class MeetupCsrf(models.EphemeralModel):
   """Stores a CSRF token for the Meetup.com OAuth2 flow."""
   token = ndb.StringProperty(required=False)
   state = ndb.TextProperty(required=False)
@@ -96,7 +97,7 @@ class Start(views.Start):
     assert MEETUP_CLIENT_ID and MEETUP_CLIENT_SECRET, \
       "Please fill in the meetup_client_id and meetup_client_secret files in your app's root directory."
 
-    csrf_key = MeetupCsrf(state=state).put()
+    csrf_key = models.state_store.put(MeetupCsrf(state=state))
 
     return GET_AUTH_CODE_URL % {
       'client_id': MEETUP_CLIENT_ID,
@@ -131,7 +132,7 @@ class Callback(views.Callback):
     except (ValueError, TypeError):
       flask_util.error(f'Invalid state value {state!r}')
 
-    csrf = MeetupCsrf.get_by_id(csrf_id)
+    csrf = models.state_store.get(ndb.Key(MeetupCsrf, csrf_id))
     if not csrf:
       flask_util.error(f'No CSRF token for id {csrf_id}')
 
@@ -172,5 +173,5 @@ class Callback(views.Callback):
 
     logger.info(f'Storing new Meetup account for ID: {user_id}')
     auth = MeetupAuth(id=user_id, access_token_str=access_token, user_json=user_json)
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=csrf.state)
@@ -1,12 +1,464 @@
 """Base datastore model class for an authenticated account.
 """
-from datetime import timezone
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import secrets
+import threading
+import time
+import zlib
 
 from google.cloud import ndb
+from google.cloud.ndb import model as ndb_model
+from requests.auth import HTTPBasicAuth
+from requests_oauthlib import OAuth2Session
 from webutil import models, util
+from webutil.util import json_dumps, json_loads
 
+from .urlopen import pooled_urlopen
 
-class BaseAuth(models.StringIdModel):
+logger = logging.getLogger(__name__)
+
+# max number of site-specific API objects to keep in the process-wide pool
+API_POOL_SIZE = 1000
+
+# refresh OAuth 2 access tokens when they're this close to expiring, in seconds
+TOKEN_EXPIRY_MARGIN = 60
+
+# number of entities to rewrite per transaction in migrate_compressed_json
+MIGRATE_BATCH_SIZE = 100
+
+# in-process cache of entities loaded by load_many
+ENTITY_CACHE_SIZE = 5000
+ENTITY_CACHE_TTL = 60  # seconds
+
+# BaseAuth.put_if_changed skips writing unchanged entities unless their
+# updated timestamp is at least this old
+UPDATED_REFRESH_INTERVAL = timedelta(days=1)
+
+# how long in-progress login state lasts in MemoryStateStore and
+# CacheStateStore, in seconds
+STATE_TTL = 60 * 60
+STATE_CACHE_SIZE = 10000
+
+# sweep_expired deletes this many keys per delete_multi call, with at most
+# SWEEP_MAX_IN_FLIGHT calls outstanding at once
+SWEEP_BATCH_SIZE = 500
+SWEEP_MAX_IN_FLIGHT = 4
+
+
+class LRUCache:
+  """A thread-safe, size-bounded, least recently used cache.
+
+  Optionally expires entries ``ttl`` seconds after they're stored. Tracks hits
+  and misses.
+
+  Attributes:
+    max_size (int): max number of entries; the least recently used entry is
+      evicted when this is exceeded
+    ttl (float): seconds after which entries expire, or None for no expiration
+    hits (int)
+    misses (int)
+  """
+  def __init__(self, max_size, ttl=None):
+    assert max_size > 0
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = self.misses = 0
+    self._data = OrderedDict()  # maps key to (value, expiration timestamp)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def __contains__(self, key):
+    with self._lock:
+      return self._get(key) is not None
+
+  def _get(self, key):
+    """Returns a (value, expiration) tuple, or None. Caller must hold the lock."""
+    entry = self._data.get(key)
+    if entry is None:
+      return None
+    elif entry[1] is not None and entry[1] < time.monotonic():
+      del self._data[key]
+      return None
+
+    self._data.move_to_end(key)
+    return entry
+
+  def get(self, key, default=None):
+    """Returns the value for ``key``, or ``default`` if it's not cached."""
+    with self._lock:
+      entry = self._get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      self.hits += 1
+      return entry[0]
+
+  def set(self, key, value, ttl=None):
+    """Stores ``value`` for ``key``, evicting the least recently used entry if
+    the cache is full.
+
+    Args:
+      key: hashable
+      value
+      ttl (float): seconds until this entry expires. Overrides :attr:`ttl`.
+    """
+    if ttl is None:
+      ttl = self.ttl
+    expires = time.monotonic() + ttl if ttl is not None else None
+    with self._lock:
+      self._data[key] = (value, expires)
+      self._data.move_to_end(key)
+      while len(self._data) > self.max_size:
+        self._data.popitem(last=False)
+
+  def pop(self, key, default=None):
+    """Removes ``key`` and returns its value, or ``default`` if it's not cached."""
+    with self._lock:
+      entry = self._data.pop(key, None)
+    return default if entry is None else entry[0]
+
+  def clear(self):
+    """Removes all entries and resets :attr:`hits` and :attr:`misses`."""
+    with self._lock:
+      self._data.clear()
+      self.hits = self.misses = 0
+
+  def stats(self):
+    """Returns a dict with ``size``, ``hits``, ``misses``, and ``hit_ratio``."""
+    total = self.hits + self.misses
+    return {
+      'size': len(self._data),
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': self.hits / total if total else 0,
+    }
+
+
+# Process-wide pool of site-specific API objects, eg tweepy.API, shared across
+# entity instances so that their HTTP sessions and connections are reused.
+# Maps (kind, key id) to (credentials fingerprint, API object).
+api_pool = LRUCache(API_POOL_SIZE)
+
+# Process-wide cache of OAuth 2 sessions. Maps (kind, key id) to
+# (token_json, RefreshingOAuth2Session).
+oauth2_sessions = LRUCache(API_POOL_SIZE)
+# Held while getting or creating a session in oauth2_sessions, so that threads
+# with a cold cache share one session and refresh its token once.
+oauth2_sessions_lock = threading.Lock()
+
+# Process-wide cache of entities loaded by load_many. Maps ndb.Key to the
+# entity's protobuf, so that each caller gets its own instance. Entries are
+# removed when an EntityCacheMixin entity is put or deleted in this process;
+# changes from other processes are seen after ENTITY_CACHE_TTL.
+entity_cache = LRUCache(ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+
+# Process-wide user_json projection measurements. Maps kind to dict with
+# entities, bytes_before, and bytes_after. Use projection_stats() to read.
+_projection_stats = {}
+_projection_stats_lock = threading.Lock()
+
+
+def project_json(obj, paths):
+  """Returns a copy of a JSON object with only the given fields.
+
+  Paths are dot-separated field names. Lists are traversed transparently, so
+  ``user.blogs.name`` keeps the ``name`` field of each element in ``blogs``.
+  A path that ends at an object keeps the whole object.
+
+  Args:
+    obj: JSON value
+    paths (sequence of str): eg ``['id', 'user.blogs.name']``
+
+  Returns:
+    JSON value
+  """
+  tree = {}
+  for path in paths:
+    node = tree
+    for part in path.split('.'):
+      node = node.setdefault(part, {})
+
+  def project(obj, tree):
+    if isinstance(obj, list):
+      return [project(elem, tree) for elem in obj]
+    elif not isinstance(obj, dict):
+      return obj
+    return {key: project(obj[key], subtree) if subtree else obj[key]
+            for key, subtree in tree.items() if key in obj}
+
+  return project(obj, tree)
+
+
+def projection_stats():
+  """Returns user_json projection measurements, per kind.
+
+  Only counts entities whose ``user_json`` was trimmed, each once.
+
+  Returns:
+    dict: maps kind (str) to dict with ``entities``, ``bytes_before``,
+    ``bytes_after``, and ``bytes_saved``
+  """
+  with _projection_stats_lock:
+    return {kind: {**stats, 'bytes_saved': stats['bytes_before'] - stats['bytes_after']}
+            for kind, stats in _projection_stats.items()}
+
+
+def token_expired(token, margin=TOKEN_EXPIRY_MARGIN):
+  """Returns True if an OAuth 2 token has expired or will expire soon.
+
+  Args:
+    token (dict): OAuth 2 token, eg from :attr:`OAuth2Session.token`
+    margin (float): seconds before ``expires_at`` to consider it expired
+
+  Returns:
+    bool: False if the token has no ``expires_at``
+  """
+  expires_at = token.get('expires_at')
+  return bool(expires_at) and float(expires_at) - margin <= time.time()
+
+
+class RefreshingOAuth2Session(OAuth2Session):
+  """An :class:`OAuth2Session` that refreshes its token once across threads.
+
+  Concurrent refreshes of the same session's token are collapsed into a single
+  token request; the other threads wait for it, then use the new token.
+  Refreshed tokens are stored in :attr:`auth_entity`'s ``token_json``.
+
+  Attributes:
+    client_secret (str)
+    auth_entity (BaseAuth): the entity that the current thread is using this
+      session for. Thread-local, since sessions are shared across threads.
+  """
+  def __init__(self, client_id, client_secret=None, auth_entity=None, **kwargs):
+    self._local = threading.local()
+    super().__init__(client_id, token_updater=self._store_token, **kwargs)
+    self.client_secret = client_secret
+    self.auth_entity = auth_entity
+    self._refresh_lock = threading.RLock()
+
+  @property
+  def auth_entity(self):
+    return getattr(self._local, 'auth_entity', None)
+
+  @auth_entity.setter
+  def auth_entity(self, entity):
+    self._local.auth_entity = entity
+
+  def refresh_token(self, token_url, **kwargs):
+    """Refreshes the token, unless another thread already has.
+
+    Skips the token request only if another thread replaced the access token
+    while this one waited for the lock, so explicit refreshes, eg after an HTTP
+    401, and tokens without ``expires_at`` are still refreshed.
+    """
+    seen = self.token.get('access_token')
+    with self._refresh_lock:
+      if self.token.get('access_token') != seen:
+        logger.debug('Token was already refreshed')
+        return self.token
+      return super().refresh_token(token_url, **kwargs)
+
+  def refresh_if_expired(self):
+    """Refreshes and stores the token if it has expired or will expire soon."""
+    with self._refresh_lock:
+      if not (self.auto_refresh_url and self.token.get('refresh_token')
+              and token_expired(self.token)):
+        return
+      token = self.refresh_token(
+        self.auto_refresh_url, auth=HTTPBasicAuth(self.client_id, self.client_secret),
+        **self.auto_refresh_kwargs)
+    self._store_token(token)
+
+  def _store_token(self, token):
+    entity = self.auth_entity
+    token_json = json_dumps(token)
+    if entity and token_json != entity.token_json:
+      logger.info(f'Storing new access token for {entity.key}')
+      entity.token_json = token_json
+      entity.put()
+
+    if entity and entity.key:
+      oauth2_sessions.set((entity._get_kind(), entity.key.id()),
+                          (token_json, self))
+
+
+class CompressedJsonProperty(ndb.BlobProperty):
+  """Property for JSON strings that stores them zlib-compressed.
+
+  Values are JSON strings, like :class:`ndb.TextProperty`, not parsed objects.
+  Reads legacy values that were stored uncompressed as text, so it can replace
+  an existing :class:`ndb.TextProperty` directly. Use
+  :func:`migrate_compressed_json` to rewrite existing entities compressed.
+
+  ndb's own ``TextProperty(compressed=True)`` can't read uncompressed values.
+  """
+  def _validate(self, value):
+    if isinstance(value, bytes):
+      try:
+        value.decode('utf-8')
+      except UnicodeError:
+        raise ndb.exceptions.BadValueError(
+          f'In field {self._name}, expected valid UTF-8, got {value!r}')
+    elif not isinstance(value, str):
+      raise ndb.exceptions.BadValueError(
+        f'In field {self._name}, expected string, got {value!r}')
+
+  def _to_base_type(self, value):
+    if isinstance(value, str):
+      value = value.encode('utf-8')
+    return zlib.compress(value)
+
+  def _from_base_type(self, value):
+    if isinstance(value, bytes):
+      return zlib.decompress(value).decode('utf-8')
+    # legacy uncompressed value; str already
+
+  @staticmethod
+  def is_legacy(entity, prop):
+    """Returns True if ``entity``'s value for ``prop`` is stored uncompressed.
+
+    Only works for entities that were just loaded from the datastore, before
+    the property is accessed.
+
+    Args:
+      entity (ndb.Model)
+      prop (CompressedJsonProperty)
+    """
+    # ndb has no public API for a property's raw stored value. Freshly loaded
+    # entities keep it in _values, wrapped in the private _BaseValue class,
+    # until the property is first accessed. This is the only place that depends
+    # on that.
+    val = entity._values.get(prop._name)
+    return isinstance(val, ndb_model._BaseValue) and isinstance(val.b_val, str)
+
+
+def migrate_compressed_json(model_class, batch_size=MIGRATE_BATCH_SIZE,
+                            start_cursor=None, max_batches=None):
+  """Rewrites entities whose :class:`CompressedJsonProperty` values are
+  uncompressed.
+
+  Runs a keys-only query over ``model_class``, then re-reads and rewrites each
+  batch in a transaction, so that concurrent updates aren't lost. Skips
+  entities that are already compressed. Intended to run in a background task;
+  pass the returned cursor to the next run to resume. Note that rewriting
+  updates ``BaseAuth.updated``.
+
+  Args:
+    model_class (type): ndb model class with :class:`CompressedJsonProperty`
+      properties
+    batch_size (int): entities per query page and transaction
+    start_cursor (ndb.Cursor): where to resume
+    max_batches (int): stop after this many batches. Defaults to no limit.
+
+  Returns:
+    (int scanned, int rewritten, ndb.Cursor next) tuple. ``next`` is None if the
+    migration is done.
+  """
+  props = [prop for prop in model_class._properties.values()
+           if isinstance(prop, CompressedJsonProperty)]
+  assert props, f'{model_class.__name__} has no CompressedJsonProperty'
+
+  query = model_class.query()
+  cursor = start_cursor
+  scanned = rewritten = batches = 0
+
+  while max_batches is None or batches < max_batches:
+    keys, cursor, more = query.fetch_page(batch_size, start_cursor=cursor,
+                                          keys_only=True)
+    batches += 1
+    scanned += len(keys)
+
+    @ndb.transactional()
+    def rewrite():
+      entities = ndb.get_multi(keys, use_cache=False)
+      legacy = []
+      for entity in entities:
+        legacy_props = [prop for prop in props if entity and
+                        CompressedJsonProperty.is_legacy(entity, prop)]
+        if legacy_props:
+          # loaded raw values are written back as is, so set them again to
+          # compress them
+          for prop in legacy_props:
+            prop._set_value(entity, prop._get_value(entity))
+          legacy.append(entity)
+
+      ndb.put_multi(legacy)
+      return len(legacy)
+
+    if keys:
+      rewritten += rewrite()
+
+    logger.info(f'{model_class.__name__}: scanned {scanned}, rewrote {rewritten}')
+    if not more:
+      return scanned, rewritten, None
+
+  return scanned, rewritten, cursor
+
+
+def load_many(keys):
+  """Loads entities, using the in-process :data:`entity_cache`.
+
+  Entities that aren't cached are loaded with a single :func:`ndb.get_multi`.
+  Cached entities are returned as new instances, so callers may modify them.
+  Hit and miss counts are available in ``entity_cache.stats()``.
+
+  Only use this for models with :class:`EntityCacheMixin`, so that they're
+  evicted from the cache when they're put or deleted.
+
+  Args:
+    keys (sequence of ndb.Key)
+
+  Returns:
+    list: entities, in the same order as ``keys``, with None for entities that
+    don't exist
+  """
+  loaded = {}
+  misses = []
+  for key in keys:
+    if key in loaded:
+      continue
+    elif (pb := entity_cache.get(key)) is not None:
+      loaded[key] = ndb_model._entity_from_protobuf(pb)
+    else:
+      loaded[key] = None
+      misses.append(key)
+
+  if misses:
+    for key, entity in zip(misses, ndb.get_multi(misses)):
+      loaded[key] = entity
+      if entity is not None:
+        try:
+          entity_cache.set(key, ndb_model._entity_to_protobuf(entity))
+        except ndb.exceptions.BadValueError as e:
+          # eg a stored entity is missing a property that's now required
+          logger.info(f"Not caching {key}: {e}")
+
+  return [loaded[key] for key in keys]
+
+
+class EntityCacheMixin:
+  """Evicts entities from :data:`entity_cache` when they're put or deleted.
+
+  For ndb models that are loaded with :func:`load_many`. Must come before
+  :class:`ndb.Model` in the base classes.
+  """
+  def _post_put_hook(self, future):
+    super()._post_put_hook(future)
+    entity_cache.pop(self.key)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    super()._post_delete_hook(key, future)
+    entity_cache.pop(key)
+
+
+class BaseAuth(EntityCacheMixin, models.StringIdModel):
   r"""Datastore base model class for an authenticated user.
 
   Provides methods that return information about this user and make OAuth-signed
@@ -24,15 +476,38 @@ class BaseAuth(models.StringIdModel):
     SCOPES_RESET (bool): True if scopes granted to a given user reset to the
       just the most recent scopes requested, False if they accumulate across auth
       flows. Currently unused, informational only.
+    USER_JSON_FIELDS (sequence of str): the ``user_json`` fields that this
+      class's methods use, as :func:`project_json` paths. None means all.
+    USER_JSON_EXTRA_FIELDS (sequence of str): additional ``user_json`` fields
+      to keep, configured by apps.
+    PROJECT_USER_JSON (bool): whether to trim ``user_json`` down to
+      ``USER_JSON_FIELDS`` and ``USER_JSON_EXTRA_FIELDS`` before storing it.
+      Off by default, since apps may use other fields. Measurements are
+      available in :func:`projection_stats`.
+    API_THREAD_SAFE (bool): whether this class's :meth:`api` objects can be
+      shared across threads. If False, they're not pooled in :data:`api_pool`.
   """
   SCOPES_RESET = None
+  API_THREAD_SAFE = True
+  USER_JSON_FIELDS = None
+  USER_JSON_EXTRA_FIELDS = ()
+  PROJECT_USER_JSON = False
 
   created = ndb.DateTimeProperty(auto_now_add=True, tzinfo=timezone.utc)
   updated = ndb.DateTimeProperty(auto_now=True, tzinfo=timezone.utc)
 
-  # A site-specific API object. Initialized on demand.
+  # A site-specific API object for this instance. Initialized on demand for
+  # entities without keys or whose API objects aren't thread safe. May also be
+  # set manually, eg in tests.
   _api_obj = None
 
+  # maps JSON property name to (JSON string, parsed value). Initialized on
+  # demand by parsed_json().
+  _parsed_json = None
+
+  # the user_json value that _project_user_json() last produced
+  _projected_user_json = None
+
   def __init__(self, *args, id=None, **kwargs):
     """Constructor. Escapes the key string id if it starts with ``__``."""
     if id and id.startswith('__'):
@@ -62,15 +537,256 @@ class BaseAuth(models.StringIdModel):
     """Returns the user's profile picture URL, if any."""
     return None
 
+  def _pre_put_hook(self):
+    """Projects ``user_json`` if :attr:`PROJECT_USER_JSON` is set."""
+    super()._pre_put_hook()
+    self._maybe_project_user_json()
+
+  def put_if_changed(self, refresh_interval=UPDATED_REFRESH_INTERVAL):
+    """Stores this entity, unless it's identical to the stored entity.
+
+    Compares :meth:`content_fingerprint` against the stored entity's, which is
+    usually already in ndb's context cache. If they match, skips the write,
+    unless the stored entity's ``updated`` is older than ``refresh_interval``.
+    Either way, keeps the stored entity's ``created``.
+
+    Use this instead of :meth:`put` when storing an entity that may not have
+    changed, eg when a returning user logs in again.
+
+    Args:
+      refresh_interval (datetime.timedelta): rewrite unchanged entities
+        anyway, to refresh ``updated``, if it's at least this old
+
+    Returns:
+      ndb.Key:
+    """
+    self._maybe_project_user_json()
+
+    stored = self.key.get() if self.key else None
+    if stored is self:
+      # the context cache has this instance, possibly modified since it was
+      # loaded, so compare against the datastore instead
+      stored = self.key.get(use_cache=False)
+
+    if stored:
+      self.created = stored.created
+      if (stored.updated
+          and datetime.now(timezone.utc) - stored.updated < refresh_interval
+          and stored.content_fingerprint() == self.content_fingerprint()):
+        logger.debug(f'{self.key} is unchanged, not storing')
+        self.updated = stored.updated
+        return self.key
+
+    return self.put()
+
+  def content_fingerprint(self):
+    """Returns a string hash of this entity's stored property values.
+
+    Excludes automatically set timestamps, eg ``created`` and ``updated``.
+    Bytes values are decoded as UTF-8 first, since eg ``user_json`` may be
+    assigned bytes but is loaded from the datastore as a string.
+    """
+    def normalize(val):
+      if isinstance(val, bytes):
+        return val.decode('utf-8', errors='backslashreplace')
+      return repr(val)
+
+    values = {}
+    for name, prop in self._properties.items():
+      if not (getattr(prop, '_auto_now', False)
+              or getattr(prop, '_auto_now_add', False)):
+        values[name] = prop._get_value(self)
+
+    serialized = json.dumps(values, sort_keys=True, default=normalize)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+  def _maybe_project_user_json(self):
+    """Projects ``user_json`` if :attr:`PROJECT_USER_JSON` is set and it
+    hasn't already been projected."""
+    if (self.PROJECT_USER_JSON and self.USER_JSON_FIELDS is not None
+        and getattr(self, 'user_json', None)
+        and self.user_json is not self._projected_user_json):
+      self._project_user_json()
+
+  def _project_user_json(self):
+    """Trims ``user_json`` to the fields in :attr:`USER_JSON_FIELDS` and
+    :attr:`USER_JSON_EXTRA_FIELDS`, and records the bytes saved.
+
+    Skips values that have nothing to trim, eg because they were already
+    projected before they were stored, so each entity is only counted once.
+
+    Subclasses may override this to project differently.
+    """
+    before = self.user_json
+    self._projected_user_json = before
+    parsed = self.parsed_json()
+    projected = project_json(
+      parsed, list(self.USER_JSON_FIELDS) + list(self.USER_JSON_EXTRA_FIELDS))
+    if projected == parsed:
+      return
+    projected = json_dumps(projected)
+
+    len_before = len(before.encode() if isinstance(before, str) else before)
+    len_after = len(projected.encode())
+    if len_after < len_before:
+      self.user_json = projected
+    else:
+      len_after = len_before
+    self._projected_user_json = self.user_json
+
+    with _projection_stats_lock:
+      stats = _projection_stats.setdefault(self._get_kind(), {
+        'entities': 0,
+        'bytes_before': 0,
+        'bytes_after': 0,
+      })
+      stats['entities'] += 1
+      stats['bytes_before'] += len_before
+      stats['bytes_after'] += len_after
+
+  def parsed_json(self, prop='user_json'):
+    """Returns the parsed value of a JSON text property, eg ``user_json``.
+
+    Cached until the property is assigned a new value. Callers shouldn't
+    modify the returned value.
+
+    Args:
+      prop (str): property name, eg ``user_json`` or ``token_json``
+
+    Returns:
+      dict or list, or None if the property is unset
+    """
+    val = getattr(self, prop)
+    if not val:
+      return None
+
+    if self._parsed_json is None:
+      self._parsed_json = {}
+
+    cached = self._parsed_json.get(prop)
+    if cached and cached[0] is val:
+      return cached[1]
+
+    parsed = json_loads(val)
+    self._parsed_json[prop] = (val, parsed)
+    return parsed
+
   def api(self):
     """Returns the site-specific Python API object, if any.
 
     Returns None if the site doesn't have a Python API. Only some do, currently
-    Instagram, Google, and Tumblr.
+    Bluesky, Flickr, Reddit, Tumblr, and Twitter.
+
+    API objects for stored entities are kept in the process-wide
+    :data:`api_pool`, keyed by kind, key id, and a fingerprint of
+    :meth:`_api_credentials`, so they're reused across entity instances. If the
+    credentials change, the pooled object is discarded and a new one is created.
+
+    API objects aren't pooled for entities without keys or classes whose
+    :attr:`API_THREAD_SAFE` is False; they're kept on the entity instead. If
+    ``_api_obj`` is set, it's always returned.
     """
-    if self._api_obj is None:
+    if self._api_obj is not None:
+      return self._api_obj
+    elif not self.key or not self.API_THREAD_SAFE:
       self._api_obj = self._api()
-    return self._api_obj
+      return self._api_obj
+
+    pool_key = (self._get_kind(), self.key.id())
+    fingerprint = self._api_fingerprint()
+    pooled = api_pool.get(pool_key)
+    if pooled and pooled[0] == fingerprint:
+      return pooled[1]
+
+    if pooled:
+      logger.debug(f'Credentials changed for {pool_key}, discarding pooled API object')
+    api = self._api()
+    if api is not None:
+      api_pool.set(pool_key, (fingerprint, api))
+    return api
+
+  def _api(self):
+    """Creates and returns a new site-specific Python API object.
+
+    Subclasses that have a Python API should override this. Callers should use
+    :meth:`api` instead, which pools these objects.
+    """
+    return None
+
+  def _api_credentials(self):
+    """Returns the credentials that :meth:`_api` uses.
+
+    Used to detect when pooled API objects are stale. Defaults to
+    :meth:`access_token`. Subclasses whose API objects depend on other
+    properties should override this.
+    """
+    try:
+      return self.access_token()
+    except NotImplementedError:
+      return None
+
+  def _oauth2_session(self, client_id, client_secret, refresh_url):
+    """Returns a cached :class:`RefreshingOAuth2Session` for ``token_json``.
+
+    Sessions for stored entities are cached process-wide in
+    :data:`oauth2_sessions`. If the token has a ``refresh_token`` and
+    ``expires_at``, expiration is checked locally, and the token is refreshed
+    and stored in ``token_json`` before it expires. ``token_json`` is updated
+    if another thread or entity instance already refreshed it.
+
+    Subclasses must have a ``token_json`` property.
+
+    Args:
+      client_id (str)
+      client_secret (str)
+      refresh_url (str): token endpoint for refreshing access tokens
+
+    Returns:
+      RefreshingOAuth2Session:
+    """
+    token = json_loads(self.token_json)
+    cache_key = (self._get_kind(), self.key.id()) if self.key else None
+
+    with oauth2_sessions_lock:
+      cached = oauth2_sessions.get(cache_key) if cache_key else None
+      if cached:
+        token_json, session = cached
+        if token_json != self.token_json:
+          # one of these is stale. use whichever token expires later.
+          if (float(token.get('expires_at') or 0) >=
+              float(session.token.get('expires_at') or 0)):
+            session.token = token
+            oauth2_sessions.set(cache_key, (self.token_json, session))
+          else:
+            self.token_json = token_json
+      else:
+        kwargs = {}
+        if token.get('refresh_token') and token.get('expires_at'):
+          kwargs = {
+            'auto_refresh_url': refresh_url,
+            'auto_refresh_kwargs': {'client_id': client_id},
+          }
+        session = RefreshingOAuth2Session(client_id, client_secret=client_secret,
+                                          token=token, **kwargs)
+        session.auth = HTTPBasicAuth(client_id, client_secret)
+        if cache_key:
+          oauth2_sessions.set(cache_key, (self.token_json, session))
+
+    # refreshes outside the lock so that other entities' sessions aren't
+    # blocked. the session's own lock makes other threads wait for it instead.
+    session.auth_entity = self
+    session.refresh_if_expired()
+
+    # another thread may have refreshed the token while this one waited
+    if session.token != json_loads(self.token_json):
+      self.token_json = json_dumps(session.token)
+
+    return session
+
+  def _api_fingerprint(self):
+    """Returns a string hash of :meth:`_api_credentials`."""
+    creds = json.dumps(self._api_credentials(), sort_keys=True, default=str)
+    return hashlib.sha256(creds.encode()).hexdigest()
 
   def access_token(self):
     """Returns the OAuth access token.
@@ -86,8 +802,9 @@ class BaseAuth(models.StringIdModel):
     Use this for making direct HTTP REST request to a site's API. Not guaranteed
     to be implemented by all sites.
 
-    The arguments, return value (urllib.request.Response), and exceptions raised
-    (urllib.error.URLError) are the same as urllib2.urlopen.
+    The arguments, return value (file-like response), and exceptions raised
+    (urllib.error.URLError) are the same as urllib2.urlopen. Implementations
+    use :func:`pooled_urlopen`.
     """
     raise NotImplementedError()
 
@@ -109,9 +826,9 @@ class BaseAuth(models.StringIdModel):
 
   @staticmethod
   def urlopen_access_token(url, access_token, api_key=None, **kwargs):
-    """Wraps urllib.request.urlopen() and adds an access_token query parameter.
+    """Wraps :func:`pooled_urlopen` and adds an access_token query parameter.
 
-    Kwargs are passed through to urlopen().
+    Kwargs are passed through to :func:`pooled_urlopen`.
     """
     params = [('access_token', access_token)]
     if api_key:
@@ -119,13 +836,21 @@ class BaseAuth(models.StringIdModel):
     url = util.add_query_params(url, params)
 
     try:
-      return util.urlopen(url, **kwargs)
+      return pooled_urlopen(url, **kwargs)
     except BaseException as e:
       util.interpret_http_exception(e)
       raise
 
 
-class OAuthRequestToken(models.StringIdModel):
+class EphemeralModel(ndb.Model):
+  """Base class for datastore models that only hold in-progress login state.
+
+  Entities older than :data:`STATE_TTL` are deleted by :func:`sweep_expired`.
+  """
+  created = ndb.DateTimeProperty(auto_now_add=True, tzinfo=timezone.utc)
+
+
+class OAuthRequestToken(EphemeralModel, models.StringIdModel):
   """Datastore model class for an OAuth 1.1 request token.
 
   This is only intermediate data. Client should use BaseAuth subclasses to make
@@ -137,10 +862,310 @@ class OAuthRequestToken(models.StringIdModel):
   state = ndb.StringProperty(required=False)
 
 
-class PkceCode(models.StringIdModel):
+class PkceCode(EphemeralModel, models.StringIdModel):
     """An OAuth2 PKCE code challenge and code verifier.
 
     The key name is the state query param value.
     """
     verifier = ndb.StringProperty(required=True)
     challenge = ndb.StringProperty(required=True)
+
+
+def sweep_expired(model_class, max_age=STATE_TTL, batch_size=SWEEP_BATCH_SIZE,
+                  max_in_flight=SWEEP_MAX_IN_FLIGHT, start_cursor=None,
+                  max_batches=None):
+  """Deletes expired :class:`EphemeralModel` entities.
+
+  Finds entities created more than ``max_age`` seconds ago with a keys-only
+  query on ``created``, then deletes them with :func:`ndb.delete_multi_async`,
+  with at most ``max_in_flight`` batches outstanding at once. Intended to run
+  in a cron job or background task; pass the returned cursor to the next run to
+  resume.
+
+  Entities stored before ``created`` existed don't have it, so they're not
+  found by this query. Use :func:`sweep_legacy` to delete those.
+
+  Args:
+    model_class (type): :class:`EphemeralModel` subclass
+    max_age (float): seconds
+    batch_size (int): keys per query page and ``delete_multi`` call
+    max_in_flight (int): max number of concurrent ``delete_multi`` calls
+    start_cursor (ndb.Cursor): where to resume
+    max_batches (int): stop after this many batches. Defaults to no limit.
+
+  Returns:
+    dict: throughput report with ``kind``, ``scanned``, ``deleted``,
+    ``batches``, ``seconds``, ``per_second``, and ``cursor``, the
+    :class:`ndb.Cursor` to resume from, or None if the sweep is done
+  """
+  assert issubclass(model_class, EphemeralModel)
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age)
+  return _sweep(model_class.query(model_class.created < cutoff), lambda keys: keys,
+                batch_size=batch_size, max_in_flight=max_in_flight,
+                start_cursor=start_cursor, max_batches=max_batches)
+
+
+def sweep_legacy(model_class, max_age=STATE_TTL, batch_size=SWEEP_BATCH_SIZE,
+                 max_in_flight=SWEEP_MAX_IN_FLIGHT, start_cursor=None,
+                 max_batches=None):
+  """Deletes :class:`EphemeralModel` entities that have no ``created``.
+
+  One-time migration for entities stored before ``created`` existed, which
+  :func:`sweep_expired` can't find, since the datastore can't query for a
+  missing property. Scans every entity of the kind with a keys-only query, loads
+  each page, and deletes the entities with no ``created`` or that have
+  expired. Resumable like :func:`sweep_expired`; run it until the returned
+  cursor is None.
+
+  Args:
+    model_class (type): :class:`EphemeralModel` subclass
+    max_age (float): seconds
+    batch_size (int): keys per query page and ``delete_multi`` call
+    max_in_flight (int): max number of concurrent ``delete_multi`` calls
+    start_cursor (ndb.Cursor): where to resume
+    max_batches (int): stop after this many batches. Defaults to no limit.
+
+  Returns:
+    dict: throughput report, same as :func:`sweep_expired`
+  """
+  assert issubclass(model_class, EphemeralModel)
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age)
+
+  def select(keys):
+    return [entity.key for entity in ndb.get_multi(keys, use_cache=False)
+            if entity and (entity.created is None or entity.created < cutoff)]
+
+  return _sweep(model_class.query(), select, batch_size=batch_size,
+                max_in_flight=max_in_flight, start_cursor=start_cursor,
+                max_batches=max_batches)
+
+
+def _sweep(query, select, batch_size, max_in_flight, start_cursor, max_batches):
+  """Runs a keys-only query and deletes some of the results. Used by
+  :func:`sweep_expired` and :func:`sweep_legacy`.
+
+  Args:
+    query (ndb.Query)
+    select (callable): takes a list of :class:`ndb.Key` from a query page,
+      returns the ones to delete
+    batch_size, max_in_flight, start_cursor, max_batches: see
+      :func:`sweep_expired`
+
+  Returns:
+    dict: throughput report, see :func:`sweep_expired`
+  """
+  start = time.monotonic()
+  cursor = start_cursor
+  scanned = deleted = batches = 0
+  in_flight = []
+
+  def wait_oldest():
+    for future in in_flight.pop(0):
+      future.check_success()
+
+  while max_batches is None or batches < max_batches:
+    keys, cursor, more = query.fetch_page(batch_size, start_cursor=cursor,
+                                          keys_only=True)
+    batches += 1
+    scanned += len(keys)
+    if keys and (keys := select(keys)):
+      if len(in_flight) >= max_in_flight:
+        wait_oldest()
+      in_flight.append(ndb.delete_multi_async(keys, use_cache=False))
+      deleted += len(keys)
+    if not more:
+      cursor = None
+      break
+
+  while in_flight:
+    wait_oldest()
+
+  seconds = time.monotonic() - start
+  report = {
+    'kind': query.kind,
+    'scanned': scanned,
+    'deleted': deleted,
+    'batches': batches,
+    'seconds': seconds,
+    'per_second': deleted / seconds if seconds else 0,
+    'cursor': cursor,
+  }
+  logger.info(f"{report['kind']}: scanned {scanned}, deleted {deleted} in {batches} batches, {seconds:.1f}s, {report['per_second']:.0f}/s")
+  return report
+
+
+def sweep_all_expired(cursors=None, legacy=False, **kwargs):
+  """Runs :func:`sweep_expired` on every :class:`EphemeralModel` subclass.
+
+  Only sweeps classes that have been imported, eg the providers that the
+  application uses.
+
+  Args:
+    cursors (dict): maps kind (str) to :class:`ndb.Cursor` to resume from, eg
+      from a previous run's reports
+    legacy (bool): run :func:`sweep_legacy` instead of :func:`sweep_expired`
+    kwargs: passed through to :func:`sweep_expired` or :func:`sweep_legacy`
+
+  Returns:
+    list of dict: :func:`sweep_expired` reports, one per kind
+  """
+  cursors = cursors or {}
+
+  classes = []
+  pending = [EphemeralModel]
+  while pending:
+    cls = pending.pop(0)
+    for subclass in cls.__subclasses__():
+      if subclass not in classes:
+        classes.append(subclass)
+        pending.append(subclass)
+
+  sweep = sweep_legacy if legacy else sweep_expired
+  return [sweep(cls, start_cursor=cursors.get(cls._get_kind()), **kwargs)
+          for cls in classes]
+
+
+class StateStore:
+  """Stores ephemeral state for in-progress logins.
+
+  This includes OAuth request tokens, PKCE codes, CSRF tokens, and per-login
+  state across the HTTP requests of a login. Values are ndb entities, eg
+  :class:`OAuthRequestToken`, but other backends don't have to store them in
+  the datastore.
+
+  All providers use the module-level :data:`state_store`. Apps can replace it,
+  eg::
+
+    models.state_store = models.MemoryStateStore()
+  """
+  def allocate_key(self, model_class):
+    """Returns a new, unused integer key for ``model_class``.
+
+    Args:
+      model_class (type): ndb model class
+
+    Returns:
+      ndb.Key:
+    """
+    raise NotImplementedError()
+
+  def put(self, entity):
+    """Stores an entity. Allocates an integer key if it doesn't have one.
+
+    Args:
+      entity (ndb.Model)
+
+    Returns:
+      ndb.Key:
+    """
+    raise NotImplementedError()
+
+  def get(self, key):
+    """Loads an entity.
+
+    Args:
+      key (ndb.Key)
+
+    Returns:
+      ndb.Model: or None if it doesn't exist or has expired
+    """
+    raise NotImplementedError()
+
+  def delete(self, key):
+    """Deletes an entity.
+
+    Args:
+      key (ndb.Key)
+    """
+    raise NotImplementedError()
+
+
+class DatastoreStateStore(StateStore):
+  """Stores login state in the datastore. The default."""
+  def allocate_key(self, model_class):
+    return model_class.allocate_ids(1)[0]
+
+  def put(self, entity):
+    return entity.put()
+
+  def get(self, key):
+    return key.get()
+
+  def delete(self, key):
+    key.delete()
+
+
+class _SerializingStateStore(StateStore):
+  """Base class for state stores that store serialized entities.
+
+  Allocates random integer ids instead of asking the datastore.
+  """
+  def allocate_key(self, model_class):
+    return ndb.Key(model_class, secrets.randbelow(2 ** 52) + 1)
+
+  def put(self, entity):
+    if not entity.key:
+      entity.key = self.allocate_key(type(entity))
+    pb = ndb_model._entity_to_protobuf(entity)
+    self._set(self._cache_key(entity.key), ndb_model.entity_pb2.Entity.serialize(pb))
+    return entity.key
+
+  def get(self, key):
+    if (data := self._get(self._cache_key(key))) is not None:
+      return ndb_model._entity_from_protobuf(
+        ndb_model.entity_pb2.Entity.deserialize(data))
+
+  def delete(self, key):
+    self._delete(self._cache_key(key))
+
+  @staticmethod
+  def _cache_key(key):
+    return b'oauth-dropins-state:' + key.urlsafe()
+
+
+class MemoryStateStore(_SerializingStateStore):
+  """Stores login state in memory, in this process only.
+
+  Only for single-instance deployments, since a login's callback has to be
+  handled by the same process that started it.
+
+  Args:
+    ttl (float): seconds until state expires
+    max_size (int): max number of logins to store
+  """
+  def __init__(self, ttl=STATE_TTL, max_size=STATE_CACHE_SIZE):
+    self.cache = LRUCache(max_size, ttl=ttl)
+
+  def _set(self, key, data):
+    self.cache.set(key, data)
+
+  def _get(self, key):
+    return self.cache.get(key)
+
+  def _delete(self, key):
+    self.cache.pop(key)
+
+
+class CacheStateStore(_SerializingStateStore):
+  """Stores login state in a shared cache, eg Redis or memcache.
+
+  Args:
+    cache (ndb.GlobalCache): eg :class:`ndb.RedisCache` or
+      :class:`ndb.MemcacheCache`
+    ttl (float): seconds until state expires
+  """
+  def __init__(self, cache, ttl=STATE_TTL):
+    self.cache = cache
+    self.ttl = ttl
+
+  def _set(self, key, data):
+    self.cache.set({key: data}, expires=self.ttl)
+
+  def _get(self, key):
+    return self.cache.get([key])[0]
+
+  def _delete(self, key):
+    self.cache.delete([key])
+
+
+state_store = DatastoreStateStore()
@@ -3,8 +3,6 @@
 Pixelfed's API is a clone of Mastodon's v1 API:
 https://docs.pixelfed.org/technical-documentation/api-v1.html
 """
-from webutil.util import json_loads
-
 from . import mastodon
 
 
@@ -24,7 +22,7 @@ class PixelfedAuth(mastodon.MastodonAuth):
 
     Example: ``https://pixelfed.social/users/ryan``
     """
-    if not (acct := json_loads(self.user_json).get('acct')):
+    if not (acct := self.parsed_json().get('acct')):
       return None
 
     instance = self.instance().strip('/')
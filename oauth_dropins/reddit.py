@@ -14,8 +14,9 @@ import urllib.parse
 from flask import request
 from google.cloud import ndb
 import praw
+from requests.auth import HTTPBasicAuth
 from webutil import appengine_info, flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import views, models
 
@@ -30,6 +31,40 @@ else:
   REDDIT_APP_KEY = util.read('reddit_app_key')
   REDDIT_APP_SECRET = util.read('reddit_app_secret')
 
+ACCESS_TOKEN_URL = 'https://www.reddit.com/api/v1/access_token'
+API_ME_URL = 'https://oauth.reddit.com/api/v1/me'
+
+# unauthenticated praw.Reddit instances, used to generate authorization URLs.
+# maps redirect URI to praw.Reddit.
+REDDIT_POOL_SIZE = 100
+_reddits = models.LRUCache(REDDIT_POOL_SIZE)
+
+
+def reddit_for(redirect_uri):
+  """Returns a configured, unauthenticated :class:`praw.Reddit`.
+
+  Instances are cached and reused per redirect URI. Don't authorize them,
+  since :meth:`praw.models.Auth.authorize` modifies the instance in place.
+
+  Args:
+    redirect_uri (str)
+
+  Returns:
+    praw.Reddit:
+  """
+  assert REDDIT_APP_KEY and REDDIT_APP_SECRET, \
+    "Please fill in the reddit_app_key and reddit_app_secret files in your app's root directory."
+
+  reddit = _reddits.get(redirect_uri)
+  if reddit is None:
+    reddit = praw.Reddit(client_id=REDDIT_APP_KEY,
+                         client_secret=REDDIT_APP_SECRET,
+                         redirect_uri=redirect_uri,
+                         user_agent=util.user_agent)
+    _reddits.set(redirect_uri, reddit)
+
+  return reddit
+
 
 class RedditAuth(models.BaseAuth):
   """An authenticated reddit user.
@@ -40,11 +75,16 @@ class RedditAuth(models.BaseAuth):
 
   reddit-specific details: implements "access_token," which is really a refresh_token
   see: https://stackoverflow.com/questions/28955541/how-to-get-access-token-reddit-api
-  The datastore entity key name is the reddit username.
+  Implements api(), which returns a praw.Reddit. The datastore entity key name is
+  the reddit username.
   """
+  # praw isn't thread safe, so don't share praw.Reddit objects across threads
+  # https://praw.readthedocs.io/en/stable/getting_started/multiple_instances.html
+  API_THREAD_SAFE = False
+
   # refresh token
   refresh_token = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty()
+  user_json = models.CompressedJsonProperty()
 
   def site_name(self):
     return 'Reddit'
@@ -55,7 +95,16 @@ class RedditAuth(models.BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('icon_img')
+    return self.parsed_json().get('icon_img')
+
+  def _api(self):
+    """Returns a praw.Reddit."""
+    assert REDDIT_APP_KEY and REDDIT_APP_SECRET, \
+      "Please fill in the reddit_app_key and reddit_app_secret files in your app's root directory."
+    return praw.Reddit(client_id=REDDIT_APP_KEY,
+                       client_secret=REDDIT_APP_SECRET,
+                       refresh_token=self.refresh_token,
+                       user_agent=util.user_agent)
 
 
 class Start(views.Start):
@@ -69,20 +118,15 @@ class Start(views.Start):
     # if state is None the reddit API redirect breaks, set to random string
     if not state:
       state = str(randint(100000, 999999))
-    assert REDDIT_APP_KEY and REDDIT_APP_SECRET, \
-      "Please fill in the reddit_app_key and reddit_app_secret files in your app's root directory."
     url = urllib.parse.urljoin(request.host_url, self.to_path)
-    reddit = praw.Reddit(client_id=REDDIT_APP_KEY,
-                         client_secret=REDDIT_APP_SECRET,
-                         redirect_uri=url,
-                         user_agent=util.user_agent)
+    reddit = reddit_for(url)
 
     # store the state for later use in the callback view
-    models.OAuthRequestToken(id=state,
-                             token_secret=state,
-                             state=state).put()
+    models.state_store.put(models.OAuthRequestToken(
+      id=state, token_secret=state, state=state))
     st = util.encode_oauth_state({'state': state, 'to_path': self.to_path})
-    return reddit.auth.url(self.scope.split(self.SCOPE_SEPARATOR), st, 'permanent')
+    return reddit.auth.url(scopes=self.scope.split(self.SCOPE_SEPARATOR), state=st,
+                           duration='permanent')
 
   @classmethod
   def button_html(cls, *args, **kwargs):
@@ -110,28 +154,78 @@ class Callback(views.Callback):
         flask_util.error(error)
 
     # look up the stored state to check authenticity
-    request_token = models.OAuthRequestToken.get_by_id(state)
+    request_token = models.state_store.get(ndb.Key(models.OAuthRequestToken, state))
     if request_token is None:
       flask_util.error(f'Invalid oauth_token: {state}')
 
+    # exchange the code for tokens, then fetch the user's profile with a single
+    # API call. we don't use praw here because its Redditor objects load
+    # attributes lazily, which can mean an extra API call per attribute.
     url = urllib.parse.urljoin(request.host_url, to_path)
-    reddit = praw.Reddit(client_id=REDDIT_APP_KEY,
-                         client_secret=REDDIT_APP_SECRET,
-                         redirect_uri=url,
-                         user_agent=util.user_agent)
-
-    refresh_token = reddit.auth.authorize(code)
-    praw_user = reddit.user.me()
-    user_json = praw_to_user(praw_user)
+    try:
+      resp = util.requests_post(ACCESS_TOKEN_URL, data={
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': url,
+      }, auth=HTTPBasicAuth(REDDIT_APP_KEY, REDDIT_APP_SECRET))
+      resp.raise_for_status()
+      token = resp.json()
+      if token.get('error'):
+        flask_util.error(f"reddit error: {token['error']}")
+
+      resp = util.requests_get(API_ME_URL, headers={
+        'Authorization': f"bearer {token['access_token']}",
+      })
+      resp.raise_for_status()
+    except BaseException as e:
+      util.interpret_http_exception(e)
+      raise
+
+    refresh_token = token.get('refresh_token')
+    user_json = json_to_user(resp.json())
     user_id = user_json.get('name')
 
     auth = RedditAuth(id=user_id,
                       refresh_token=refresh_token,
                       user_json=json_dumps(user_json))
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=state)
 
 
+def json_to_user(user):
+  """Converts a reddit API account JSON object to a dict user.
+
+  The output matches :func:`praw_to_user`.
+
+  Args:
+    user (dict): reddit account, eg from ``/api/v1/me``
+
+  Returns:
+    dict:
+  """
+  if user.get('is_suspended'):
+    return {}
+
+  subreddit = user.get('subreddit')
+  if subreddit:
+    fullname = subreddit.get('name')
+    subreddit = {
+      # praw's Subreddit.id is the fullname without its t5_ prefix
+      'id': fullname.removeprefix('t5_') if fullname else None,
+      'display_name': subreddit.get('display_name'),
+      'name': fullname,
+      'description': subreddit.get('public_description'),
+    }
+
+  return {
+    'name': user.get('name'),
+    'subreddit': subreddit,
+    'icon_img': user.get('icon_img'),
+    'id': user.get('id'),
+    'created_utc': user.get('created_utc'),
+  }
+
+
 def praw_to_user(user):
   """
   Converts a PRAW user to a dict user.
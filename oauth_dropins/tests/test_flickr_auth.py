@@ -0,0 +1,84 @@
+"""Unit tests for flickr_auth.py streaming uploads.
+"""
+import email.parser
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from .. import flickr_auth
+from .testutil import StandInServer
+
+
+class NonSeekable(io.RawIOBase):
+  """A non-seekable stream, like an HTTP response or a pipe."""
+  def __init__(self, data):
+    self._data = io.BytesIO(data)
+
+  def readable(self):
+    return True
+
+  def readinto(self, buf):
+    data = self._data.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+class UploadTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    for name in 'FLICKR_APP_KEY', 'FLICKR_APP_SECRET':
+      patcher = mock.patch.object(flickr_auth, name, 'fake')
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def handle(self, req):
+    return 200, {}, b'<rsp stat="ok"><photoid>123</photoid></rsp>'
+
+  def upload(self, file, **kwargs):
+    with StandInServer(self.handle) as server, \
+         mock.patch.object(flickr_auth, 'UPLOAD_URL', server.url + '/upload'):
+      self.server = server
+      self.assertEqual({'id': '123'}, flickr_auth.upload(
+        {'title': 'foo'}, file, 'key', 'secret', **kwargs))
+
+    [req] = self.server.requests
+    msg = email.parser.BytesParser().parsebytes(
+      f'Content-Type: {req.headers["Content-Type"]}\r\n\r\n'.encode() + req.body)
+    self.fields = {part.get_param('name', header='Content-Disposition'):
+                   part.get_payload(decode=True) for part in msg.get_payload()}
+    return req
+
+  def test_seekable(self):
+    req = self.upload(io.BytesIO(b'abcdef'))
+    self.assertEqual(str(len(req.body)), req.headers['Content-Length'])
+    self.assertIsNone(req.headers['Transfer-Encoding'])
+    self.assertEqual(b'abcdef', self.fields['photo'])
+    self.assertEqual(b'foo', self.fields['title'])
+    self.assertIn('oauth_signature', self.fields)
+
+  def test_not_seekable_chunked(self):
+    data = os.urandom(flickr_auth.UPLOAD_CHUNK_SIZE * 2 + 10)
+    req = self.upload(io.BufferedReader(NonSeekable(data)))
+    self.assertEqual('chunked', req.headers['Transfer-Encoding'])
+    self.assertIsNone(req.headers['Content-Length'])
+    self.assertEqual(data, self.fields['photo'])
+
+  def test_not_seekable_with_size(self):
+    req = self.upload(io.BufferedReader(NonSeekable(b'abcdefgh')), size=5)
+    self.assertEqual(str(len(req.body)), req.headers['Content-Length'])
+    self.assertEqual(b'abcde', self.fields['photo'])
+
+  def test_empty_path(self):
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as f:
+      pass
+    try:
+      req = self.upload(f.name)
+    finally:
+      os.unlink(f.name)
+
+    self.assertEqual(str(len(req.body)), req.headers['Content-Length'])
+    self.assertEqual(b'', self.fields['photo'])
+    self.assertIn(f'filename="{os.path.basename(f.name)}"', req.body.decode())
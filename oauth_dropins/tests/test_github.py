@@ -0,0 +1,48 @@
+"""Unit tests for github.py conditional requests.
+"""
+import unittest
+
+from ..github import ETagCache, GitHubAuth
+from .testutil import StandInServer
+
+
+class ETagCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.auth = GitHubAuth(access_token_str='towkin')
+    self.auth.etag_cache = ETagCache(10)
+
+  def handle(self, req):
+    accept = req.headers['Accept']
+    etag = f'"{accept}"'
+    if req.headers['If-None-Match'] == etag:
+      return 304, {'ETag': etag, 'X-RateLimit-Remaining': '9'}, b''
+    return 200, {'ETag': etag, 'Content-Type': accept}, accept.encode()
+
+  def test_not_modified(self):
+    with StandInServer(self.handle) as server:
+      first = self.auth.get(server.url + '/repos/foo/bar')
+      second = self.auth.get(server.url + '/repos/foo/bar')
+
+    self.assertEqual(200, second.status_code)
+    self.assertEqual(first.text, second.text)
+    self.assertEqual('9', second.headers['X-RateLimit-Remaining'])
+    self.assertEqual('Bearer towkin', server.requests[1].headers['Authorization'])
+    self.assertEqual(1, self.auth.etag_cache.not_modified)
+
+  def test_keyed_on_accept(self):
+    url = '/repos/foo/bar/readme'
+    with StandInServer(self.handle) as server:
+      json = self.auth.get(server.url + url)
+      raw = self.auth.get(server.url + url,
+                          headers={'Accept': 'application/vnd.github.raw'})
+      raw_again = self.auth.get(server.url + url,
+                                headers={'accept': 'application/vnd.github.raw'})
+
+    self.assertNotEqual('application/vnd.github.raw', json.text)
+    self.assertEqual('application/vnd.github.raw', raw.text)
+    self.assertEqual('application/vnd.github.raw', raw_again.text)
+    self.assertIsNone(server.requests[1].headers['If-None-Match'])
+    self.assertEqual('"application/vnd.github.raw"',
+                     server.requests[2].headers['If-None-Match'])
@@ -0,0 +1,242 @@
+"""Unit tests for models.py.
+"""
+import os
+import threading
+import time
+from unittest import mock
+import zlib
+
+from google.cloud import ndb
+from google.cloud.ndb import global_cache
+from google.cloud.ndb import model as ndb_model
+from webutil.util import json_dumps, json_loads
+
+from .. import models, twitter_v2
+from ..github import GitHubAuth
+from ..mastodon import MastodonApp, MastodonLogin
+from ..models import OAuthRequestToken, PkceCode
+from ..reddit import RedditAuth
+from ..tumblr import TumblrAuth
+from ..twitter_v2 import TwitterOAuth2
+from .testutil import NdbTestCase, StandInServer
+
+
+class ApiTest(NdbTestCase):
+
+  def setUp(self):
+    super().setUp()
+    models.api_pool.clear()
+    patcher = mock.patch.object(TumblrAuth, '_api', side_effect=object)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def tumblr(self, token_key='k'):
+    return TumblrAuth(id='alice', token_key=token_key, token_secret='s')
+
+  def test_pooled_across_instances(self):
+    self.assertIs(self.tumblr().api(), self.tumblr().api())
+    self.assertEqual(1, len(models.api_pool))
+
+  def test_credentials_changed(self):
+    api = self.tumblr().api()
+    self.assertIsNot(api, self.tumblr(token_key='new').api())
+
+  def test_no_key_not_pooled(self):
+    auth = TumblrAuth(token_key='k', token_secret='s')
+    self.assertIs(auth.api(), auth.api())
+    self.assertEqual(0, len(models.api_pool))
+
+  def test_manual_api_obj(self):
+    auth = self.tumblr()
+    auth._api_obj = 'fake'
+    self.assertEqual('fake', auth.api())
+
+  def test_not_thread_safe_not_pooled(self):
+    with mock.patch.object(RedditAuth, '_api', side_effect=object):
+      alice = RedditAuth(id='alice', refresh_token='r')
+      self.assertIs(alice.api(), alice.api())
+      self.assertIsNot(alice.api(), RedditAuth(id='alice', refresh_token='r').api())
+
+    self.assertEqual(0, len(models.api_pool))
+
+
+class OAuth2SessionTest(NdbTestCase):
+
+  def setUp(self):
+    super().setUp()
+    models.oauth2_sessions.clear()
+    for patcher in (
+        mock.patch.object(TwitterOAuth2, 'put'),
+        mock.patch.object(twitter_v2, 'TWITTER_CLIENT_ID', 'fake'),
+        mock.patch.object(twitter_v2, 'TWITTER_CLIENT_SECRET', 'fake'),
+        # the stand-in token endpoint is plain HTTP
+        mock.patch.dict(os.environ, {'OAUTHLIB_INSECURE_TRANSPORT': '1'}),
+    ):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def handle(self, req):
+    time.sleep(.1)  # give the other threads time to pile up
+    return 200, {'Content-Type': 'application/json'}, json_dumps({
+      'access_token': 'new',
+      'refresh_token': 'new-refresh',
+      'token_type': 'bearer',
+      'expires_in': 7200,
+    }).encode()
+
+  def auth(self):
+    return TwitterOAuth2(id='alice', token_json=json_dumps({
+      'access_token': 'old',
+      'refresh_token': 'old-refresh',
+      'token_type': 'bearer',
+      'expires_at': time.time() - 10,
+    }))
+
+  def test_cold_cache_concurrent_refresh_once(self):
+    auths = [self.auth() for _ in range(5)]
+    sessions = [None] * len(auths)
+
+    def session(i):
+      with self.ndb_client.context():
+        sessions[i] = auths[i].session()
+
+    # widen the window between the cache miss and the cache set
+    real_session = models.RefreshingOAuth2Session
+    def slow_session(*args, **kwargs):
+      time.sleep(.05)
+      return real_session(*args, **kwargs)
+
+    with StandInServer(self.handle) as server, \
+         mock.patch.object(twitter_v2, 'ACCESS_TOKEN_URL', server.url + '/token'), \
+         mock.patch.object(models, 'RefreshingOAuth2Session', side_effect=slow_session):
+      threads = [threading.Thread(target=session, args=(i,))
+                 for i in range(len(auths))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(1, len(server.requests))
+    self.assertEqual(1, len({id(session) for session in sessions}))
+    self.assertEqual('new', sessions[0].token['access_token'])
+    for auth in auths:
+      token = json_loads(auth.token_json)
+      self.assertEqual('new', token['access_token'])
+      self.assertEqual('new-refresh', token['refresh_token'])
+
+
+class MigrateCompressedJsonTest(NdbTestCase):
+
+  def load(self, user_json, legacy):
+    """Returns a GitHubAuth as if loaded from the datastore."""
+    pb = ndb_model._entity_to_protobuf(GitHubAuth(
+      id='alice', access_token_str='towkin', user_json=user_json))
+    if legacy:
+      pb._pb.properties['user_json'].string_value = user_json
+    return ndb_model._entity_from_protobuf(pb)
+
+  def test_rewrites_legacy_compressed(self):
+    legacy = self.load('{"login":"alice"}', legacy=True)
+    compressed = self.load('{"login":"bob"}', legacy=False)
+    self.assertTrue(models.CompressedJsonProperty.is_legacy(
+      legacy, GitHubAuth.user_json))
+
+    query = mock.Mock()
+    deleted = ndb.Key(GitHubAuth, 'eve')
+    query.fetch_page.return_value = (
+      [legacy.key, compressed.key, deleted], None, False)
+    with mock.patch.object(GitHubAuth, 'query', return_value=query), \
+         mock.patch.object(ndb, 'transactional', return_value=lambda fn: fn), \
+         mock.patch.object(ndb, 'get_multi', return_value=[legacy, compressed, None]), \
+         mock.patch.object(ndb, 'put_multi') as put_multi:
+      self.assertEqual((3, 1, None),
+                       models.migrate_compressed_json(GitHubAuth))
+
+    put_multi.assert_called_once_with([legacy])
+
+    # what would be stored
+    stored = ndb_model._entity_to_protobuf(legacy).properties['user_json']
+    self.assertEqual(b'{"login":"alice"}', zlib.decompress(stored.blob_value))
+
+    reloaded = ndb_model._entity_from_protobuf(ndb_model._entity_to_protobuf(legacy))
+    self.assertFalse(models.CompressedJsonProperty.is_legacy(
+      reloaded, GitHubAuth.user_json))
+    self.assertEqual('{"login":"alice"}', reloaded.user_json)
+
+
+class StateStoreTest(NdbTestCase):
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(models, 'state_store', models.state_store)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def stores(self):
+    return (models.MemoryStateStore(),
+            models.CacheStateStore(global_cache._InProcessGlobalCache()))
+
+  def test_default_is_datastore(self):
+    self.assertIsInstance(models.state_store, models.DatastoreStateStore)
+
+  def test_put_get_string_id(self):
+    for store in self.stores():
+      with self.subTest(store=store.__class__.__name__):
+        key = store.put(OAuthRequestToken(id='tok', token_secret='sekret',
+                                          state='st8'))
+        self.assertEqual(ndb.Key(OAuthRequestToken, 'tok'), key)
+
+        got = store.get(ndb.Key(OAuthRequestToken, 'tok'))
+        self.assertIsInstance(got, OAuthRequestToken)
+        self.assertEqual(key, got.key)
+        self.assertEqual('sekret', got.token_secret)
+        self.assertEqual('st8', got.state)
+
+        self.assertIsNone(store.get(ndb.Key(OAuthRequestToken, 'other')))
+        self.assertIsNone(store.get(ndb.Key(PkceCode, 'tok')))
+
+  def test_put_allocates_key(self):
+    app_key = ndb.Key(MastodonApp, 'https://inst/')
+    for store in self.stores():
+      with self.subTest(store=store.__class__.__name__):
+        key = store.put(MastodonLogin(app=app_key, state='st8'))
+        self.assertEqual('MastodonLogin', key.kind())
+        self.assertIsInstance(key.id(), int)
+
+        got = store.get(key)
+        self.assertEqual(app_key, got.app)
+        self.assertEqual('st8', got.state)
+
+  def test_allocate_key_unique(self):
+    for store in self.stores():
+      with self.subTest(store=store.__class__.__name__):
+        keys = {store.allocate_key(MastodonLogin) for _ in range(100)}
+        self.assertEqual(100, len(keys))
+
+  def test_delete(self):
+    for store in self.stores():
+      with self.subTest(store=store.__class__.__name__):
+        key = store.put(PkceCode(id='st8', challenge='ch', verifier='ver'))
+        store.delete(key)
+        self.assertIsNone(store.get(key))
+
+  def test_memory_expires(self):
+    store = models.MemoryStateStore(ttl=0.01)
+    key = store.put(PkceCode(id='st8', challenge='ch', verifier='ver'))
+    time.sleep(0.02)
+    self.assertIsNone(store.get(key))
+
+  def test_cache_expires(self):
+    cache = global_cache._InProcessGlobalCache()
+    store = models.CacheStateStore(cache, ttl=123)
+    with mock.patch.object(cache, 'set', wraps=cache.set) as set:
+      store.put(PkceCode(id='st8', challenge='ch', verifier='ver'))
+    self.assertEqual({'expires': 123}, set.call_args.kwargs)
+
+  def test_providers_use_state_store(self):
+    models.state_store = models.MemoryStateStore()
+    key = models.state_store.put(
+      MastodonLogin(app=ndb.Key(MastodonApp, 'https://inst/'), state='st8'))
+
+    login = MastodonLogin.load(str(key.id()))
+    self.assertEqual('st8', login.state)
@@ -0,0 +1,147 @@
+"""Unit tests for twitter_auth.py chunked media uploads.
+"""
+import email.parser
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+import urllib.parse
+
+import requests
+from webutil.util import json_dumps
+
+from .. import twitter_auth
+from .testutil import StandInServer
+
+
+def form(req):
+  """Returns a stand-in request's form fields, urlencoded or multipart.
+
+  Multipart values are decoded to str, except for ``media``, which stays bytes.
+  """
+  content_type = req.headers['Content-Type']
+  if content_type.startswith('multipart/form-data'):
+    msg = email.parser.BytesParser().parsebytes(
+      f'Content-Type: {content_type}\r\n\r\n'.encode() + req.body)
+    fields = {}
+    for part in msg.get_payload():
+      name = part.get_param('name', header='Content-Disposition')
+      value = part.get_payload(decode=True)
+      fields[name] = value if name == 'media' else value.decode()
+    return fields
+
+  return {name: vals[0] for name, vals in
+          urllib.parse.parse_qs(req.body.decode()).items()}
+
+
+class UploadMediaTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    for name in 'TWITTER_APP_KEY', 'TWITTER_APP_SECRET':
+      patcher = mock.patch.object(twitter_auth, name, 'fake')
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.statuses = []
+    self.append_status = 204
+
+  def handle(self, req):
+    if req.method == 'GET':
+      command = req.query['command'][0]
+    else:
+      command = form(req)['command']
+
+    if command == 'INIT':
+      return 202, {}, json_dumps({'media_id_string': '123'}).encode()
+    elif command == 'APPEND':
+      return self.append_status, {}, b''
+    elif command in ('FINALIZE', 'STATUS'):
+      resp = {'media_id_string': '123'}
+      if self.statuses:
+        resp['processing_info'] = {'state': self.statuses.pop(0),
+                                   'check_after_secs': 0}
+      return 200, {'Content-Type': 'application/json'}, json_dumps(resp).encode()
+
+    return 400, {}, b''
+
+  def upload(self, file, **kwargs):
+    with StandInServer(self.handle) as server, \
+         mock.patch.object(twitter_auth, 'UPLOAD_MEDIA_URL', server.url + '/upload'):
+      self.server = server
+      return twitter_auth.upload_media(file, 'key', 'secret', 'video/mp4',
+                                       segment_size=4, **kwargs)
+
+  def commands(self):
+    return [req.query['command'][0] if req.method == 'GET'
+            else form(req)['command'] for req in self.server.requests]
+
+  def appends(self):
+    appends = [form(req) for req in self.server.requests
+               if req.method == 'POST' and form(req)['command'] == 'APPEND']
+    return sorted((int(a['segment_index']), a['media']) for a in appends)
+
+  def test_upload_file(self):
+    resp = self.upload(io.BytesIO(b'abcdefghij'), media_category='tweet_video')
+    self.assertEqual({'media_id_string': '123'}, resp)
+    self.assertEqual(['INIT', 'APPEND', 'APPEND', 'APPEND', 'FINALIZE'],
+                     self.commands())
+
+    init = form(self.server.requests[0])
+    self.assertEqual({
+      'command': 'INIT',
+      'total_bytes': '10',
+      'media_type': 'video/mp4',
+      'media_category': 'tweet_video',
+    }, init)
+    self.assertEqual([(0, b'abcd'), (1, b'efgh'), (2, b'ij')], self.appends())
+    self.assertTrue(all(req.headers['Authorization'].startswith('OAuth ')
+                        for req in self.server.requests))
+
+  def test_upload_path_concurrent(self):
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+      f.write(b'0123456789abcdef')
+    try:
+      self.upload(f.name, max_concurrent=3)
+    finally:
+      os.unlink(f.name)
+
+    self.assertEqual('16', form(self.server.requests[0])['total_bytes'])
+    self.assertEqual([(0, b'0123'), (1, b'4567'), (2, b'89ab'), (3, b'cdef')],
+                     self.appends())
+    self.assertEqual('FINALIZE', self.commands()[-1])
+
+  def test_upload_empty_path(self):
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+      pass
+    try:
+      self.upload(f.name)
+    finally:
+      os.unlink(f.name)
+
+    self.assertEqual('0', form(self.server.requests[0])['total_bytes'])
+    self.assertEqual(['INIT', 'FINALIZE'], self.commands())
+
+  def test_status_polling(self):
+    self.statuses = ['pending', 'in_progress', 'succeeded']
+    with mock.patch('time.sleep') as sleep:
+      resp = self.upload(io.BytesIO(b'abc'))
+
+    self.assertEqual('succeeded', resp['processing_info']['state'])
+    self.assertEqual(['INIT', 'APPEND', 'FINALIZE', 'STATUS', 'STATUS'],
+                     self.commands())
+    self.assertEqual({'command': ['STATUS'], 'media_id': ['123']},
+                     self.server.requests[-1].query)
+    self.assertEqual(2, sleep.call_count)
+
+  def test_processing_failed(self):
+    self.statuses = ['failed']
+    with self.assertRaises(RuntimeError):
+      self.upload(io.BytesIO(b'abc'))
+
+  def test_append_error(self):
+    self.append_status = 400
+    with self.assertRaises(requests.HTTPError):
+      self.upload(io.BytesIO(b'abcdefgh'))
+
+    self.assertNotIn('FINALIZE', self.commands())
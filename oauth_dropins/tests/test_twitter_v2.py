@@ -0,0 +1,90 @@
+"""Unit tests for twitter_v2.py batched user refreshes.
+"""
+import os
+import time
+from unittest import mock
+
+from webutil.util import json_dumps, json_loads
+
+from .. import models, twitter_v2
+from ..twitter_v2 import TwitterOAuth2
+from .testutil import NdbTestCase, StandInServer
+
+
+class RefreshUsersTest(NdbTestCase):
+
+  def setUp(self):
+    super().setUp()
+    models.oauth2_sessions.clear()
+    for patcher in (
+        mock.patch.object(twitter_v2, 'TWITTER_CLIENT_ID', 'fake'),
+        mock.patch.object(twitter_v2, 'TWITTER_CLIENT_SECRET', 'fake'),
+        mock.patch.object(TwitterOAuth2, 'put'),
+        # the stand-in token endpoint is plain HTTP
+        mock.patch.dict(os.environ, {'OAUTHLIB_INSECURE_TRANSPORT': '1'}),
+    ):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def handle(self, req):
+    if req.path == '/token':
+      resp = {
+        'access_token': 'new',
+        'refresh_token': 'new-refresh',
+        'token_type': 'bearer',
+        'expires_in': 7200,
+      }
+    else:
+      resp = {'data': [{'id': id, 'username': f'new-{id}'}
+                       for id in req.query['ids'][0].split(',')]}
+    return 200, {'Content-Type': 'application/json'}, json_dumps(resp).encode()
+
+  def auth(self, id, expires_at):
+    return TwitterOAuth2(
+      id=f'user{id}',
+      user_json=json_dumps({'data': {'id': id, 'username': f'user{id}'}}),
+      token_json=json_dumps({
+        'access_token': 'towkin',
+        'refresh_token': 'refresh',
+        'token_type': 'bearer',
+        'expires_at': expires_at,
+      }))
+
+  def refresh_users(self, auths, **kwargs):
+    with StandInServer(self.handle) as server, \
+         mock.patch.object(twitter_v2, 'ACCESS_TOKEN_URL', server.url + '/token'), \
+         mock.patch.object(twitter_v2, 'API_USERS_URL', server.url + '/2/users'), \
+         mock.patch('google.cloud.ndb.put_multi') as put_multi:
+      self.server = server
+      changed = TwitterOAuth2.refresh_users(auths, **kwargs)
+
+    if changed:
+      put_multi.assert_called_once_with(changed)
+    return changed
+
+  def lookups(self):
+    return [req for req in self.server.requests if req.path == '/2/users']
+
+  def test_default_user_token(self):
+    auths = [self.auth('1', time.time() + 3600), self.auth('2', time.time() + 3600)]
+    self.assertEqual(auths, self.refresh_users(auths))
+
+    [lookup] = self.lookups()
+    self.assertEqual({'ids': ['1,2']}, lookup.query)
+    self.assertEqual('Bearer towkin', lookup.headers['Authorization'])
+    self.assertEqual({'data': {'id': '2', 'username': 'new-2'}},
+                     json_loads(auths[1].user_json))
+
+  def test_default_user_token_refreshed_first(self):
+    auth = self.auth('1', time.time() - 10)
+    self.refresh_users([auth])
+
+    self.assertEqual(['/token', '/2/users'],
+                     [req.path for req in self.server.requests])
+    self.assertEqual('Bearer new', self.lookups()[0].headers['Authorization'])
+
+  def test_bearer_token(self):
+    self.refresh_users([self.auth('1', time.time() - 10)], bearer_token='app')
+
+    [lookup] = self.server.requests
+    self.assertEqual('Bearer app', lookup.headers['Authorization'])
@@ -0,0 +1,84 @@
+"""Unit tests for wordpress_rest.py batch requests.
+"""
+import unittest
+from unittest import mock
+import urllib.error
+
+from webutil.util import json_dumps
+
+from .. import wordpress_rest
+from ..wordpress_rest import WordPressAuth
+from .testutil import StandInServer
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.auth = WordPressAuth(access_token_str='towkin')
+    self.fail_batch = None
+
+  def handle(self, req):
+    paths = req.query['urls[]']
+    if paths == self.fail_batch:
+      return 500, {}, b'oops'
+
+    resp = {}
+    for path in paths:
+      if 'missing' in path:
+        continue
+      elif 'bad' in path:
+        resp[path] = {'error': 'invalid_input', 'message': 'Bad input'}
+      elif 'gone' in path:
+        resp[path] = {'errors': [{'error': 'unknown_post',
+                                  'message': 'Unknown post'}],
+                      'status_code': 404}
+      else:
+        resp[path] = {'path': path}
+
+    return 200, {'Content-Type': 'application/json'}, json_dumps(resp).encode()
+
+  def batch(self, paths, **kwargs):
+    with StandInServer(self.handle) as server, \
+         mock.patch.object(wordpress_rest, 'API_BATCH_URL', server.url + '/batch'):
+      self.server = server
+      return self.auth.batch(paths, **kwargs)
+
+  def test_splits_into_batches(self):
+    paths = [f'/sites/123/posts/{i}' for i in range(5)]
+    results = self.batch(paths, batch_size=2)
+
+    self.assertEqual([{'path': path} for path in paths], results)
+    self.assertEqual([paths[0:2], paths[2:4], paths[4:5]],
+                     [req.query['urls[]'] for req in self.server.requests])
+    for req in self.server.requests:
+      self.assertEqual('/batch', req.path)
+      self.assertEqual('Bearer towkin', req.headers['Authorization'])
+
+  def test_full_urls(self):
+    results = self.batch([wordpress_rest.API_BASE_URL + '/sites/123'])
+    self.assertEqual([{'path': '/sites/123'}], results)
+    self.assertEqual(['/sites/123'], self.server.requests[0].query['urls[]'])
+
+  def test_per_request_errors(self):
+    ok, missing, bad, gone = self.batch(
+      ['/ok', '/missing', '/bad', '/gone'])
+
+    self.assertEqual({'path': '/ok'}, ok)
+    for err, code, msg in ((missing, 502, 'Missing from batch response'),
+                           (bad, 400, 'Bad input'),
+                           (gone, 404, 'Unknown post')):
+      self.assertIsInstance(err, urllib.error.HTTPError)
+      self.assertEqual(code, err.code)
+      self.assertEqual(msg, err.reason)
+
+  def test_batch_request_fails(self):
+    self.fail_batch = ['/c', '/d']
+    results = self.batch(['/a', '/b', '/c', '/d', '/e'], batch_size=2)
+
+    self.assertEqual([{'path': '/a'}, {'path': '/b'}], results[:2])
+    for err in results[2:4]:
+      self.assertIsInstance(err, urllib.error.HTTPError)
+      self.assertEqual(500, err.code)
+    self.assertEqual({'path': '/e'}, results[4])
+    self.assertEqual(3, len(self.server.requests))
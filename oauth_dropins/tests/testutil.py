@@ -0,0 +1,108 @@
+"""Test utilities: an ndb test case and a local HTTP server that stands in for
+site APIs.
+"""
+import http.server
+import os
+import threading
+import unittest
+from unittest import mock
+import urllib.parse
+
+from google.cloud import ndb
+
+
+class StandInServer:
+  """A local HTTP server that records requests and returns canned responses.
+
+  Use as a context manager. ``handler`` is called with each
+  :class:`Request` and returns a (status, headers dict, body bytes) tuple.
+
+  Attributes:
+    url (str): base URL, eg ``http://127.0.0.1:1234``
+    requests (list of Request): requests received so far
+  """
+  class Request:
+    """A request received by :class:`StandInServer`.
+
+    Attributes:
+      method (str)
+      path (str): without query
+      query (dict): maps str name to list of str values
+      headers (email.message.Message)
+      body (bytes)
+    """
+    def __init__(self, method, path, headers, body):
+      parsed = urllib.parse.urlparse(path)
+      self.method = method
+      self.path = parsed.path
+      self.query = urllib.parse.parse_qs(parsed.query)
+      self.headers = headers
+      self.body = body
+
+  def __init__(self, handler):
+    self.requests = []
+    self._lock = threading.Lock()
+    server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def read_chunked(self):
+        chunks = []
+        while size := int(self.rfile.readline().split(b';')[0], 16):
+          chunks.append(self.rfile.read(size))
+          self.rfile.readline()
+        # skip trailers
+        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+          pass
+        return b''.join(chunks)
+
+      def handle_any(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+          body = self.read_chunked()
+        else:
+          body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        req = StandInServer.Request(self.command, self.path, self.headers, body)
+        with server._lock:
+          server.requests.append(req)
+        status, headers, resp_body = handler(req)
+        self.send_response(status)
+        for name, value in headers.items():
+          self.send_header(name, value)
+        self.send_header('Content-Length', str(len(resp_body)))
+        self.end_headers()
+        self.wfile.write(resp_body)
+
+      do_GET = do_POST = handle_any
+
+      def log_message(self, *args):
+        pass
+
+    self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+  def __enter__(self):
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *args):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+class NdbTestCase(unittest.TestCase):
+  """Runs each test in an ndb context.
+
+  The context doesn't connect to a datastore, so tests can create keys and
+  entities but not load or store them.
+
+  Attributes:
+    ndb_client (ndb.Client): for creating contexts in other threads
+  """
+  def setUp(self):
+    super().setUp()
+    with mock.patch.dict(os.environ, {'DATASTORE_EMULATOR_HOST': 'localhost:1'}):
+      self.ndb_client = ndb.Client(project='oauth-dropins-test')
+    context = self.ndb_client.context()
+    context.__enter__()
+    self.addCleanup(context.__exit__, None, None, None)
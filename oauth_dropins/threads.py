@@ -5,11 +5,9 @@ https://developers.facebook.com/docs/threads/
 import logging
 
 from flask import request
-from google.cloud import ndb
-from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session
 from webutil import flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import models, views
 
@@ -47,44 +45,31 @@ class ThreadsAuth(models.BaseAuth):
   The datastore entity key name is the integer user id.
   """
   # Fields: token_type, access_token, scope, expires_at, expires_in
-  token_json = ndb.TextProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  token_json = models.CompressedJsonProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Threads'
 
   def user_display_name(self):
     """Returns the username."""
-    return json_loads(self.user_json).get('username')
+    return self.parsed_json().get('username')
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('threads_profile_picture_url')
+    return self.parsed_json().get('threads_profile_picture_url')
 
   def access_token(self):
     """Returns the OAuth access token JSON."""
-    return json_loads(self.token_json)['access_token']
+    return self.parsed_json('token_json')['access_token']
 
   def session(self):
-    """Returns a :class:`requests_oauthlib.OAuth2Session`."""
-    token = json_loads(self.token_json)
+    """Returns a :class:`models.RefreshingOAuth2Session`.
 
-    kwargs = {}
-    if token.get('refresh_token') and token.get('expires_at'):
-      def update_token(token):
-        logging.info(f'Storing new access token {token}')
-        self.token = token
-        self.put()
-
-      kwargs = {
-        'auto_refresh_url': ACCESS_TOKEN_URL,
-        'auto_refresh_kwargs': {'client_id': APP_ID},
-        'token_updater': update_token,
-      }
-
-    session = OAuth2Session(APP_ID, token=token, **kwargs)
-    session.auth = HTTPBasicAuth(APP_ID, APP_SECRET)
-    return session
+    Sessions are cached per entity. Expired tokens are refreshed, once across
+    threads, and stored in :attr:`token_json`.
+    """
+    return self._oauth2_session(APP_ID, APP_SECRET, ACCESS_TOKEN_URL)
 
 
 class Start(views.Start):
@@ -146,6 +131,6 @@ class Callback(views.Callback):
     auth = ThreadsAuth(id=str(session.token['user_id']),
                        token_json=json_dumps(session.token),
                        user_json=json_dumps(user_json))
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))
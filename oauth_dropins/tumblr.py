@@ -4,6 +4,7 @@ API docs:
 http://www.tumblr.com/docs/en/api/v2
 http://www.tumblr.com/oauth/apps
 """
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import urllib.parse
 
@@ -11,7 +12,7 @@ from flask import request
 from google.cloud import ndb
 import tumblpy
 from webutil import flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import views, models
 
@@ -20,6 +21,9 @@ logger = logging.getLogger(__name__)
 TUMBLR_APP_KEY = util.read('tumblr_app_key')
 TUMBLR_APP_SECRET = util.read('tumblr_app_secret')
 
+# Tumblpy's requests session keeps up to 10 connections per host
+BLOGS_INFO_MAX_WORKERS = 8
+
 
 class TumblrAuth(models.BaseAuth):
   """An authenticated Tumblr user.
@@ -28,14 +32,17 @@ class TumblrAuth(models.BaseAuth):
   requests to the Tumblr API. Stores OAuth credentials in the datastore. See
   models.BaseAuth for usage details.
 
-  Tumblr-specific details: implements api() but not urlopen(). api()
-  returns a tumblpy.Tumblpy. The datastore entity key name is the Tumblr
-  username.
+  Tumblr-specific details: implements api() and blogs_info() but not
+  urlopen(). api() returns a tumblpy.Tumblpy. The datastore entity key name is
+  the Tumblr username.
   """
+  USER_JSON_FIELDS = ('user.name', 'user.blogs.name', 'user.blogs.url',
+                      'user.blogs.avatar')
+
   # access token
   token_key = ndb.StringProperty(required=True)
   token_secret = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Tumblr'
@@ -46,7 +53,7 @@ class TumblrAuth(models.BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    if blogs :=json_loads(self.user_json).get('user', {}).get('blogs', []):
+    if blogs :=self.parsed_json().get('user', {}).get('blogs', []):
       if avatars := blogs[0].get('avatar', []):
         return avatars[0].get('url')
 
@@ -54,6 +61,40 @@ class TumblrAuth(models.BaseAuth):
     """Returns the OAuth access token as a (string key, string secret) tuple."""
     return (self.token_key, self.token_secret)
 
+  def blogs_info(self, max_workers=BLOGS_INFO_MAX_WORKERS):
+    """Fetches info for all of this user's blogs in parallel.
+
+    Runs the ``blog/.../info`` calls concurrently in a bounded thread pool over
+    the pooled :meth:`api` object's signed session. Failures are per blog:
+    exceptions are returned instead of raised.
+
+    http://www.tumblr.com/docs/en/api/v2#blog-info
+
+    Args:
+      max_workers (int): max number of calls to run at once
+
+    Returns:
+      dict: maps blog name to its ``blog`` info dict or the exception, in the
+      same order as the blogs in :attr:`user_json`
+    """
+    blogs = self.parsed_json().get('user', {}).get('blogs', [])
+    if not blogs:
+      return {}
+
+    api = self.api()
+
+    def info(blog):
+      try:
+        return api.get('info', blog_url=blog.get('url'))['blog']
+      except BaseException as e:
+        util.interpret_http_exception(e)
+        logger.info(f"info for {blog.get('name')} failed: {e}")
+        return e
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(blogs))) as executor:
+      return dict(zip((blog.get('name') for blog in blogs),
+                      executor.map(info, blogs)))
+
   def _api(self):
     """Returns a tumblpy.Tumblpy."""
     return TumblrAuth._api_from_token(self.token_key, self.token_secret)
@@ -83,9 +124,9 @@ class Start(views.Start):
       callback_url=urllib.parse.urljoin(request.host_url, self.to_path))
 
     # store the request token for later use in the callback view
-    models.OAuthRequestToken(id=auth_props['oauth_token'],
-                             token_secret=auth_props['oauth_token_secret'],
-                             state=state).put()
+    models.state_store.put(models.OAuthRequestToken(
+      id=auth_props['oauth_token'], token_secret=auth_props['oauth_token_secret'],
+      state=state))
     return auth_props['auth_url']
 
   @classmethod
@@ -107,7 +148,8 @@ class Callback(views.Callback):
       return self.finish(None)
 
     # look up the request token
-    request_token = models.OAuthRequestToken.get_by_id(request_token_key)
+    request_token = models.state_store.get(
+      ndb.Key(models.OAuthRequestToken, request_token_key))
     if request_token is None:
       flask_util.error(f'Invalid oauth_token: {request_token_key}')
 
@@ -136,5 +178,5 @@ class Callback(views.Callback):
                       token_key=auth_token_key,
                       token_secret=auth_token_secret,
                       user_json=json_dumps(resp))
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=request_token.state)
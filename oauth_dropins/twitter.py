@@ -26,16 +26,17 @@ class TwitterAuth(models.BaseAuth):
   requests to the Twitter v1.1 API. Stores OAuth credentials in the datastore.
   See models.BaseAuth for usage details.
 
-  Twitter-specific details: implements api(), get(), and post(). api() returns a
-  tweepy.API; get() and post() wrap the corresponding requests methods. The
-  datastore entity key name is the Twitter username.
+  Twitter-specific details: implements api(), get(), post(), and
+  upload_media(). api() returns a tweepy.API; get() and post() wrap the
+  corresponding requests methods. The datastore entity key name is the Twitter
+  username.
   """
   SCOPES_RESET = True
 
   # access token
   token_key = ndb.StringProperty(required=True)
   token_secret = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Twitter'
@@ -46,7 +47,7 @@ class TwitterAuth(models.BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('profile_image_url_https')
+    return self.parsed_json().get('profile_image_url_https')
 
   def access_token(self):
     """Returns the OAuth access token as a (string key, string secret) tuple."""
@@ -79,7 +80,22 @@ class TwitterAuth(models.BaseAuth):
       raise
     return resp
 
-  def api(self):
+  def upload_media(self, file, media_type, **kwargs):
+    """Uploads a photo or video with Twitter's chunked media upload API.
+
+    See :func:`twitter_auth.upload_media` for details. Kwargs are passed through.
+
+    Args:
+      file: file-like object opened in binary mode, or str path to a file
+      media_type (str): MIME type, eg ``video/mp4``
+
+    Returns:
+      dict: the final upload response, including ``media_id_string``
+    """
+    return twitter_auth.upload_media(file, self.token_key, self.token_secret,
+                                     media_type, **kwargs)
+
+  def _api(self):
     """Returns a tweepy.API."""
     return tweepy.API(twitter_auth.tweepy_auth(self.token_key, self.token_secret))
 
@@ -127,9 +143,9 @@ class Start(views.Start):
       signin_with_twitter=not self.access_type, access_type=self.access_type)
 
     # store the request token for later use in the callback view
-    models.OAuthRequestToken(id=auth.request_token['oauth_token'],
-                             token_secret=auth.request_token['oauth_token_secret']
-                             ).put()
+    models.state_store.put(models.OAuthRequestToken(
+      id=auth.request_token['oauth_token'],
+      token_secret=auth.request_token['oauth_token_secret']))
     logger.info(f'Generated request token, redirecting to Twitter: {auth_url}')
     return auth_url
 
@@ -147,7 +163,8 @@ class Callback(views.Callback):
       flask_util.error('Missing required query parameter oauth_token.')
 
     # Lookup the request token
-    request_token = models.OAuthRequestToken.get_by_id(oauth_token)
+    request_token = models.state_store.get(
+      ndb.Key(models.OAuthRequestToken, oauth_token))
     if request_token is None:
       flask_util.error(f'Invalid oauth_token: {oauth_token}')
 
@@ -168,5 +185,5 @@ class Callback(views.Callback):
                        token_key=access_token_key,
                        token_secret=access_token_secret,
                        user_json=user_json)
-    auth.put()
+    auth.put_if_changed()
     return self.finish(auth, state=request.values.get('state'))
@@ -5,6 +5,13 @@ it without pulling in App Engine dependencies.
 
 Supports Python 3. Should not depend on App Engine API or SDK packages.
 """
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import mmap
+import os
+import threading
+import time
 import urllib.request
 
 import requests
@@ -12,9 +19,18 @@ import requests_oauthlib
 import tweepy
 from webutil import util
 
+from .urlopen import pooled_urlopen
+
+logger = logging.getLogger(__name__)
+
 TWITTER_APP_KEY = util.read('twitter_app_key')
 TWITTER_APP_SECRET = util.read('twitter_app_secret')
 
+# https://developer.twitter.com/en/docs/twitter-api/v1/media/upload-media/uploading-media/chunked-media-upload
+UPLOAD_MEDIA_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+UPLOAD_SEGMENT_SIZE = 4 * 1024 * 1024  # bytes; Twitter's max is 5MB
+UPLOAD_MAX_STATUS_WAIT = 600  # seconds
+
 
 def auth_header(url, token_key, token_secret, method='GET'):
   """Generates an Authorization header and returns it in a header dict.
@@ -39,7 +55,7 @@ def auth_header(url, token_key, token_secret, method='GET'):
 
 
 def signed_urlopen(url, token_key, token_secret, headers=None, **kwargs):
-  """Wraps urllib.request.urlopen() and adds an OAuth signature.
+  """Wraps :func:`pooled_urlopen` and adds an OAuth signature.
   """
   if headers is None:
     headers = {}
@@ -55,7 +71,146 @@ def signed_urlopen(url, token_key, token_secret, headers=None, **kwargs):
     method = 'GET'
 
   headers.update(auth_header(url, token_key, token_secret, method=method))
-  return util.urlopen(urllib.request.Request(url, headers=headers, **kwargs))
+  return pooled_urlopen(urllib.request.Request(url, headers=headers, **kwargs))
+
+
+def auth(token_key, token_secret):
+  """Returns a :class:`requests_oauthlib.OAuth1` for the given access token."""
+  return requests_oauthlib.OAuth1(
+    client_key=TWITTER_APP_KEY,
+    client_secret=TWITTER_APP_SECRET,
+    resource_owner_key=token_key,
+    resource_owner_secret=token_secret,
+  )
+
+
+def upload_media(file, token_key, token_secret, media_type, total_bytes=None,
+                 media_category=None, segment_size=UPLOAD_SEGMENT_SIZE,
+                 max_concurrent=1, max_status_wait=UPLOAD_MAX_STATUS_WAIT):
+  """Uploads a photo or video with Twitter's chunked media upload API.
+
+  Runs the ``INIT``, ``APPEND``, ``FINALIZE``, and ``STATUS`` commands. Reads
+  and uploads the file one segment at a time, so at most ``max_concurrent``
+  segments are in memory at once.
+
+  Args:
+    file: file-like object opened in binary mode, or str path to a file, which
+      will be memory-mapped
+    token_key (str): the user's access token
+    token_secret (str): the user's access token secret
+    media_type (str): MIME type, eg ``video/mp4``
+    total_bytes (int): size of the file. Only required if ``file`` isn't
+      seekable.
+    media_category (str): optional, eg ``tweet_video``. Required for videos
+      and GIFs longer than 30s.
+    segment_size (int): bytes per ``APPEND`` request
+    max_concurrent (int): max number of ``APPEND`` requests to run in parallel
+    max_status_wait (float): seconds to wait for Twitter to finish processing
+
+  Returns:
+    dict: the final ``FINALIZE`` or ``STATUS`` response, including
+    ``media_id_string``
+
+  Raises:
+    requests.HTTPError: on HTTP error
+    RuntimeError: if Twitter fails to process the media, or it doesn't finish
+      within ``max_status_wait``
+  """
+  if isinstance(file, (str, os.PathLike)):
+    kwargs = {'media_category': media_category, 'segment_size': segment_size,
+              'max_concurrent': max_concurrent,
+              'max_status_wait': max_status_wait}
+    with open(file, 'rb') as f:
+      if not os.fstat(f.fileno()).st_size:
+        # mmap can't map empty files
+        return upload_media(io.BytesIO(b''), token_key, token_secret,
+                            media_type, total_bytes=0, **kwargs)
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return upload_media(mm, token_key, token_secret, media_type,
+                            total_bytes=len(mm), **kwargs)
+
+  oauth1 = auth(token_key, token_secret)
+
+  def post(**kwargs):
+    resp = util.requests_post(UPLOAD_MEDIA_URL, auth=oauth1, **kwargs)
+    try:
+      resp.raise_for_status()
+    except BaseException as e:
+      util.interpret_http_exception(e)
+      raise
+    return resp
+
+  if total_bytes is None:
+    start = file.tell()
+    file.seek(0, io.SEEK_END)
+    total_bytes = file.tell() - start
+    file.seek(start)
+
+  init = {
+    'command': 'INIT',
+    'total_bytes': total_bytes,
+    'media_type': media_type,
+  }
+  if media_category:
+    init['media_category'] = media_category
+  media_id = post(data=init).json()['media_id_string']
+  logger.info(f'Uploading {total_bytes} bytes to media id {media_id}')
+
+  def append(index, segment):
+    try:
+      post(data={
+        'command': 'APPEND',
+        'media_id': media_id,
+        'segment_index': index,
+      }, files={'media': io.BytesIO(segment)})
+    finally:
+      slots.release()
+
+  # the semaphore bounds the number of segments read but not yet uploaded
+  slots = threading.BoundedSemaphore(max_concurrent)
+  with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+    futures = []
+    for index in range((total_bytes + segment_size - 1) // segment_size):
+      slots.acquire()
+      if any(f.done() and f.exception() for f in futures):
+        slots.release()
+        break
+      futures.append(executor.submit(append, index, file.read(segment_size)))
+
+    for future in futures:
+      future.result()
+
+  resp = post(data={'command': 'FINALIZE', 'media_id': media_id}).json()
+
+  # poll for processing status, with backoff
+  # https://developer.twitter.com/en/docs/twitter-api/v1/media/upload-media/api-reference/get-media-upload-status
+  deadline = time.monotonic() + max_status_wait
+  delay = 1
+  while info := resp.get('processing_info'):
+    state = info.get('state')
+    if state == 'succeeded':
+      break
+    elif state == 'failed':
+      raise RuntimeError(f'Twitter failed to process media {media_id}: {info.get("error")}')
+    elif time.monotonic() >= deadline:
+      raise RuntimeError(f'Twitter did not finish processing media {media_id} within {max_status_wait}s')
+
+    delay = max(info.get('check_after_secs') or 0, delay)
+    time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+    delay = min(delay * 2, 60)
+
+    resp = util.requests_get(UPLOAD_MEDIA_URL, auth=oauth1, params={
+      'command': 'STATUS',
+      'media_id': media_id,
+    })
+    try:
+      resp.raise_for_status()
+    except BaseException as e:
+      util.interpret_http_exception(e)
+      raise
+    resp = resp.json()
+
+  return resp
 
 
 def tweepy_auth(token_key, token_secret):
@@ -10,11 +10,10 @@ import time
 
 from flask import request
 from google.cloud import ndb
-from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session
 from urllib.parse import quote_plus, unquote, urlencode, urljoin, urlparse, urlunparse
 from webutil import flask_util, util
-from webutil.util import json_dumps, json_loads
+from webutil.util import json_dumps
 
 from . import models, views
 
@@ -26,6 +25,9 @@ TWITTER_CLIENT_SECRET = util.read('twitter_app_secret')
 AUTH_CODE_URL = 'https://twitter.com/i/oauth2/authorize'
 ACCESS_TOKEN_URL = 'https://api.twitter.com/2/oauth2/token'
 API_ACCOUNT_URL = 'https://api.twitter.com/2/users/me'
+# https://developer.twitter.com/en/docs/twitter-api/users/lookup/api-reference/get-users
+API_USERS_URL = 'https://api.twitter.com/2/users'
+USERS_LOOKUP_BATCH_SIZE = 100
 
 # https://developer.twitter.com/en/docs/authentication/oauth-2-0/authorization-code
 ALL_SCOPES = (
@@ -58,8 +60,8 @@ class TwitterOAuth2(models.BaseAuth):
   The datastore entity key name is the Twitter username.
   """
   # Fields: token_type, access_token, scope, expires_at, expires_in
-  token_json = ndb.TextProperty(required=True)
-  user_json = ndb.TextProperty(required=True)
+  token_json = models.CompressedJsonProperty(required=True)
+  user_json = models.CompressedJsonProperty(required=True)
 
   def site_name(self):
     return 'Twitter'
@@ -70,31 +72,84 @@ class TwitterOAuth2(models.BaseAuth):
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatar')
+    return self.parsed_json().get('avatar')
 
   def access_token(self):
     """Returns the OAuth access token JSON."""
-    return json_loads(self.token_json)['access_token']
+    return self.parsed_json('token_json')['access_token']
 
   def session(self):
-    """Returns a :class:`requests_oauthlib.OAuth2Session`."""
-    token = json_loads(self.token_json)
-
-    if token.get('refresh_token') and token.get('expires_at'):
-      def update_token(token):
-        logging.info(f'Storing new access token {token}')
-        self.token = token
-        self.put()
-
-      kwargs = {
-        'auto_refresh_url': ACCESS_TOKEN_URL,
-        'auto_refresh_kwargs': {'client_id': TWITTER_CLIENT_ID},
-        'token_updater': update_token,
-      }
-
-    session = OAuth2Session(TWITTER_CLIENT_ID, token=token, **kwargs)
-    session.auth = HTTPBasicAuth(TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET)
-    return session
+    """Returns a :class:`models.RefreshingOAuth2Session`.
+
+    Sessions are cached per entity. Expired tokens are refreshed, once across
+    threads, and stored in :attr:`token_json`.
+    """
+    return self._oauth2_session(TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET,
+                                ACCESS_TOKEN_URL)
+
+  @classmethod
+  def refresh_users(cls, auths, bearer_token=None):
+    """Refetches many users' profiles and stores the ones that changed.
+
+    Looks up users in batches of up to :const:`USERS_LOOKUP_BATCH_SIZE` ids
+    with ``/2/users?ids=...``, then stores the entities whose :attr:`user_json`
+    changed with a single :func:`ndb.put_multi`. Users that Twitter doesn't
+    return, eg because they've been suspended or deleted, are left unchanged.
+
+    Args:
+      auths (sequence of TwitterOAuth2)
+      bearer_token (str): app-only bearer token to use. Defaults to the first
+        entity's user token.
+
+    Returns:
+      list of TwitterOAuth2: the entities that changed and were stored
+    """
+    by_id = {}
+    for auth in auths:
+      id = (auth.parsed_json() or {}).get('data', {}).get('id')
+      if id:
+        by_id[id] = auth
+      else:
+        logger.warning(f"{auth.key} user_json has no id, can't refresh")
+
+    if not by_id:
+      return []
+
+    if not bearer_token:
+      # session() refreshes the token if necessary. don't send requests through
+      # it, since its HTTP Basic auth would override the bearer token.
+      first = next(iter(by_id.values()))
+      first.session()
+      bearer_token = first.access_token()
+    headers = {'Authorization': f'Bearer {bearer_token}'}
+
+    changed = []
+    ids = list(by_id.keys())
+    for i in range(0, len(ids), USERS_LOOKUP_BATCH_SIZE):
+      batch = ids[i:i + USERS_LOOKUP_BATCH_SIZE]
+      resp = util.requests_get(API_USERS_URL, params={'ids': ','.join(batch)},
+                               headers=headers)
+      try:
+        resp.raise_for_status()
+      except BaseException as e:
+        util.interpret_http_exception(e)
+        raise
+
+      resp_json = resp.json()
+      for error in resp_json.get('errors', []):
+        logger.info(f"Couldn't look up user: {error}")
+
+      for user in resp_json.get('data', []):
+        auth = by_id.get(user.get('id'))
+        if auth and {'data': user} != auth.parsed_json():
+          auth.user_json = json_dumps({'data': user})
+          changed.append(auth)
+
+    if changed:
+      logger.info(f'Storing {len(changed)} changed users')
+      ndb.put_multi(changed)
+
+    return changed
 
 
 class Start(views.Start):
@@ -117,7 +172,8 @@ class Start(views.Start):
 
     # generate and store PKCE code
     verifier = secrets.token_urlsafe(64)
-    key = models.PkceCode(id=state, challenge=verifier, verifier=verifier).put()
+    key = models.state_store.put(
+      models.PkceCode(id=state, challenge=verifier, verifier=verifier))
     logging.info(f'Storing PKCE code verifier {verifier}: {key}')
 
     # redirect to Twitter auth URL
@@ -147,7 +203,7 @@ class Callback(views.Callback):
         flask_util.error(msg)
 
     # look up PKCE code verifier
-    code = models.PkceCode.get_by_id(state)
+    code = models.state_store.get(ndb.Key(models.PkceCode, state)) if state else None
     if not code:
       flask_util.error(f'state not found: {state}')
     logging.info(f'Loaded PKCE code {code}')
@@ -168,6 +224,6 @@ class Callback(views.Callback):
 
     auth = TwitterOAuth2(id=username, token_json=json_dumps(session.token),
                          user_json=json_dumps(user_json))
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))
@@ -0,0 +1,115 @@
+"""Drop-in replacement for :func:`urllib.request.urlopen` that reuses connections.
+
+This is a separate module from models.py so that twitter_auth.py and
+flickr_auth.py can use it without pulling in App Engine dependencies.
+
+Supports Python 3. Should not depend on App Engine API or SDK packages.
+"""
+import http.client
+import io
+import logging
+import urllib.error, urllib.parse, urllib.request
+
+import requests
+from webutil import util
+
+logger = logging.getLogger(__name__)
+
+# urllib.request.urlopen kwargs that requests doesn't support. It manages TLS
+# itself, with certifi's CA bundle by default.
+IGNORED_URLOPEN_KWARGS = ('context', 'cadefault')
+
+
+class PooledResponse(io.BytesIO):
+  """File-like HTTP response returned by :func:`pooled_urlopen`.
+
+  Mimics the response from :func:`urllib.request.urlopen`: supports ``read``,
+  ``readline``, iteration, and ``with``, and has ``url``, ``status``,
+  ``code``, ``reason``, and ``headers`` attributes and ``geturl``, ``getcode``,
+  and ``info`` methods.
+  """
+  def __init__(self, resp):
+    super().__init__(resp.content)
+    self.url = resp.url
+    self.status = self.code = resp.status_code
+    self.reason = self.msg = resp.reason
+    self.headers = http.client.HTTPMessage()
+    for name, value in resp.headers.items():
+      self.headers[name] = value
+
+  def geturl(self):
+    return self.url
+
+  def getcode(self):
+    return self.status
+
+  def info(self):
+    return self.headers
+
+  def getheader(self, name, default=None):
+    return self.headers.get(name, default)
+
+  def getheaders(self):
+    return self.headers.items()
+
+
+def pooled_urlopen(url_or_req, data=None, timeout=None, **kwargs):
+  """Drop-in replacement for :func:`webutil.util.urlopen` that reuses
+  connections.
+
+  Sends requests through :data:`webutil.util.session`, the same keep-alive
+  connection pools that :func:`webutil.util.requests_get` etc use, instead of
+  opening a new connection for each request.
+
+  Args:
+    url_or_req (str or urllib.request.Request)
+    data (bytes or str): request body. If provided, the request is a POST.
+    timeout (float): seconds. Defaults to :data:`webutil.util.HTTP_TIMEOUT`.
+    kwargs: other :func:`urllib.request.urlopen` kwargs. ``cafile`` and
+      ``capath`` are used to verify TLS certificates; ``context`` and
+      ``cadefault`` are ignored. Anything else is passed through to
+      :meth:`requests.Session.request`.
+
+  Returns:
+    PooledResponse:
+
+  Raises:
+    urllib.error.HTTPError: on HTTP 4xx or 5xx. ``read()`` returns the body.
+    urllib.error.URLError: on connection failure
+  """
+  req = url_or_req
+  if not isinstance(req, urllib.request.Request):
+    req = urllib.request.Request(req)
+  if data is not None:
+    req.data = data
+  if isinstance(req.data, str):
+    req.data = req.data.encode()
+
+  for name in IGNORED_URLOPEN_KWARGS:
+    kwargs.pop(name, None)
+  cafile = kwargs.pop('cafile', None)
+  capath = kwargs.pop('capath', None)
+  if cafile or capath:
+    kwargs.setdefault('verify', cafile or capath)
+
+  url = req.get_full_url()
+  method = req.get_method()
+  headers = requests.structures.CaseInsensitiveDict(req.header_items())
+  headers.setdefault('User-Agent', util.user_agent)
+  if req.data is not None:
+    # urllib's default
+    headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+  logger.info(f'urlopen {method} {url}')
+  util.check_ssrf(urllib.parse.urlparse(url).hostname)
+  try:
+    resp = util.session.request(method, url, data=req.data, headers=headers,
+                                timeout=timeout or util.HTTP_TIMEOUT, **kwargs)
+  except requests.RequestException as e:
+    raise urllib.error.URLError(e)
+
+  pooled = PooledResponse(resp)
+  if not resp.ok:
+    raise urllib.error.HTTPError(url, resp.status_code, resp.reason,
+                                 pooled.headers, pooled)
+  return pooled
@@ -19,7 +19,7 @@ You can then test on your local machine by running dev_appserver and opening
 http://my.dev.com:8080/ instead of http://localhost:8080/ .
 """
 import logging
-import urllib.parse, urllib.request
+import urllib.error, urllib.parse, urllib.request
 
 from flask import request
 from google.cloud import ndb
@@ -27,7 +27,8 @@ from webutil import appengine_info, flask_util, util
 from webutil.util import json_dumps, json_loads
 
 from . import views
-from .models import BaseAuth
+from .models import BaseAuth, CompressedJsonProperty
+from .urlopen import pooled_urlopen
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +52,10 @@ GET_AUTH_CODE_URL = '&'.join((
 ))
 GET_ACCESS_TOKEN_URL = 'https://public-api.wordpress.com/oauth2/token'
 API_USER_URL = 'https://public-api.wordpress.com/rest/v1/me?pretty=true'
+API_BASE_URL = 'https://public-api.wordpress.com/rest/v1.1'
+# https://developer.wordpress.com/docs/api/1.1/get/batch/
+API_BATCH_URL = f'{API_BASE_URL}/batch'
+BATCH_SIZE = 20
 
 
 class WordPressAuth(BaseAuth):
@@ -60,13 +65,13 @@ class WordPressAuth(BaseAuth):
   OAuth-signed requests to the WordPress REST API. Stores OAuth credentials in
   the datastore. See models.BaseAuth for usage details.
 
-  WordPress-specific details: implements :meth:`urlopen` but not :meth:`api`.
-  The key name is the blog hostname.
+  WordPress-specific details: implements :meth:`urlopen` and :meth:`batch` but
+  not :meth:`api`. The key name is the blog hostname.
   """
   blog_id = ndb.StringProperty(required=True)
   blog_url = ndb.StringProperty(required=True)
   access_token_str = ndb.StringProperty(required=True)
-  user_json = ndb.TextProperty()
+  user_json = CompressedJsonProperty()
 
   def site_name(self):
     return 'WordPress'
@@ -76,12 +81,12 @@ class WordPressAuth(BaseAuth):
     if not self.user_json:
       return self.key_id()
 
-    user = json_loads(self.user_json)
+    user = self.parsed_json()
     return user.get('display_name') or user.get('username')
 
   def image_url(self):
     """Returns the user's profile picture URL, if any."""
-    return json_loads(self.user_json).get('avatar_URL')
+    return self.parsed_json().get('avatar_URL')
 
   def access_token(self):
     """Returns the OAuth access token string."""
@@ -92,11 +97,63 @@ class WordPressAuth(BaseAuth):
     kwargs.setdefault('headers', {})['authorization'] = \
         'Bearer ' + self.access_token_str
     try:
-      return util.urlopen(urllib.request.Request(url, **kwargs))
+      return pooled_urlopen(urllib.request.Request(url, **kwargs))
     except BaseException as e:
       util.interpret_http_exception(e)
       raise
 
+  def batch(self, paths, batch_size=BATCH_SIZE):
+    """Makes many GET requests to the REST API with as few batch requests as
+    possible.
+
+    Failures are per request: errors become :class:`urllib.error.HTTPError`\s,
+    like :meth:`urlopen` raises. They're returned instead of raised. If a
+    whole batch request fails, each of its requests gets that exception.
+
+    Args:
+      paths (sequence of str): API paths relative to :data:`API_BASE_URL`,
+        optionally with query params, eg ``/sites/123/posts?number=20``. Full
+        URLs that start with :data:`API_BASE_URL` are also accepted.
+      batch_size (int): max number of requests per batch request
+
+    Returns:
+      list: one result per path, in the same order, either the parsed JSON
+      response or the exception
+    """
+    paths = [path.removeprefix(API_BASE_URL) for path in paths]
+    results = []
+
+    for i in range(0, len(paths), batch_size):
+      chunk = paths[i:i + batch_size]
+      url = util.add_query_params(API_BATCH_URL,
+                                  [('urls[]', path) for path in chunk])
+      try:
+        resp = json_loads(self.urlopen(url).read())
+      except BaseException as e:
+        logger.info(f'Batch request failed: {e}')
+        results.extend(e for _ in chunk)
+        continue
+
+      for path in chunk:
+        result = resp.get(path)
+        if result is None:
+          result = urllib.error.HTTPError(
+            API_BASE_URL + path, 502, 'Missing from batch response', {}, None)
+        elif isinstance(result, dict) and ('error' in result or
+                                           'errors' in result):
+          # errors look like either {"error": "...", "message": "..."} or
+          # {"errors": [...], "status_code": 404}
+          errors = result.get('errors')
+          error = (errors[0] if isinstance(errors, list) and errors else result)
+          msg = (error.get('message') or error.get('error')
+                 if isinstance(error, dict) else str(error))
+          result = urllib.error.HTTPError(
+            API_BASE_URL + path, result.get('status_code') or 400, msg, {},
+            None)
+        results.append(result)
+
+    return results
+
 
 class Start(views.Start):
   """Starts WordPress auth. Requests an auth code and expects a redirect back.
@@ -172,6 +229,6 @@ class Callback(views.Callback):
                          blog_url=blog_url,
                          access_token_str=access_token)
     auth.user_json = auth.urlopen(API_USER_URL).read()
-    auth.put()
+    auth.put_if_changed()
 
     return self.finish(auth, state=request.values.get('state'))